@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2019 Stefan Kienzle
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Precomputed frame tables for the Blinkt! led animations.
+#
+# Every animation cycle is computed once (per color and brightness) and stored as a
+# tuple of frames. A frame is a `bytes` object with the r, g, b values of all pixels,
+# so playing an animation is just a table lookup per frame.
+
+import colorsys
+import functools
+import math
+import time
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import blinkt
+except ImportError:
+    blinkt = None
+
+
+NUM_PIXELS = 8
+FRAME_INTERVAL = 0.04
+
+FrameTable = namedtuple('FrameTable', ['frames', 'brightness', 'interval'])
+
+
+# Convert arrays of hsv values (0..1) into a flat array of rgb bytes
+def hsv_to_rgb_bytes(h, s, v):
+    if np is None:
+        rgb = bytearray()
+        for pixel in zip(h, s, v):
+            rgb.extend(int(255.0 * c) for c in colorsys.hsv_to_rgb(*pixel))
+        return bytes(rgb)
+
+    h, s, v = np.broadcast_arrays(np.asarray(h, float), np.asarray(s, float), np.asarray(v, float))
+    i = np.floor(h * 6.0)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i.astype(int) % 6
+
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+
+    return (np.stack([r, g, b], axis=-1) * 255.0).astype(np.uint8).tobytes()
+
+
+# Pulse effect (Blinkt example pulse.py): a gaussian that contracts and widens again
+# https://github.com/pimoroni/blinkt/blob/master/examples/pulse.py
+@functools.lru_cache(maxsize=None)
+def pulse_frames(color, brightness=1.0):
+    # Only hue and saturation of the color are used, the value is taken from the gaussian
+    h, s, _ = colorsys.rgb_to_hsv(*[float(c) for c in color])
+
+    hues, saturations, values = [], [], []
+    for z in list(range(1, 10)[::-1]) + list(range(1, 10)):
+        fwhm = 5.0 / z
+        for x in range(NUM_PIXELS):
+            hues.append(h)
+            saturations.append(s)
+            values.append(math.exp(-4 * math.log(2) * ((x - 3.5) ** 2 + 0.5 ** 2) / fwhm ** 2))
+
+    return _frame_table(hsv_to_rgb_bytes(hues, saturations, values), brightness)
+
+
+# Rainbow effect (Blinkt example rainbow.py)
+# https://github.com/pimoroni/blinkt/blob/master/examples/rainbow.py
+@functools.lru_cache(maxsize=None)
+def rainbow_frames(brightness=0.1):
+    spacing = 360.0 / 16.0
+
+    hues = []
+    for hue in range(0, 360, 4):
+        for x in range(NUM_PIXELS):
+            hues.append(((hue + x * spacing) % 360) / 360.0)
+
+    return _frame_table(hsv_to_rgb_bytes(hues, [1.0] * len(hues), [1.0] * len(hues)), brightness)
+
+
+def _frame_table(rgb, brightness):
+    size = NUM_PIXELS * 3
+    frames = tuple(rgb[i:i + size] for i in range(0, len(rgb), size))
+    return FrameTable(frames, brightness, FRAME_INTERVAL)
+
+
+# Write a single frame to the Blinkt! led bar
+def show_frame(table, index):
+    frame = table.frames[index % len(table.frames)]
+    for x in range(NUM_PIXELS):
+        blinkt.set_pixel(x, frame[x * 3], frame[x * 3 + 1], frame[x * 3 + 2], table.brightness)
+    blinkt.show()
+
+
+# Play a frame table at a fixed frame rate until `duration` is over or `stop` (a
+# `threading.Event`) is set. Frames are skipped instead of slowing down the animation
+# if the thread was not scheduled in time.
+def play_frames(table, duration=None, stop=None):
+    start = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        if duration is not None and now - start >= duration:
+            return True
+
+        index = int((now - start) / table.interval)
+        show_frame(table, index)
+
+        delay = start + (index + 1) * table.interval - time.monotonic()
+        if stop is None:
+            time.sleep(max(delay, 0))
+        elif stop.wait(max(delay, 0)):
+            return False
@@ -22,8 +22,6 @@
 # SOFTWARE.
 #
 
-import colorsys
-import time
 import argparse
 from sys import exit
 
@@ -32,10 +30,7 @@ try:
 except ImportError:
     exit('This script requires the blinkt module\nInstall with: curl https://get.pimoroni.com/blinkt | bash')
 
-try:
-    import numpy as np
-except ImportError:
-    exit('This script requires the numpy module\nInstall with: sudo pip install numpy')
+from blinkt_led_frames import play_frames, pulse_frames
 
 # Parse the command line arguments
 arg_parser = argparse.ArgumentParser(description='Flash the Blinkt! led indicators.')
@@ -46,43 +41,7 @@ print(args)
 
 
 blinkt.set_clear_on_exit(True)
-blinkt.set_brightness(args.brightness)
-
-
-# Convert rgb color to hsv values (rgb string have to be converted into array of float values)
-hsv = colorsys.rgb_to_hsv(*([float(x) for x in args.color.split(',')]))
-print(hsv)
-
-
-# Blinkt example pulse.py
-# https://github.com/pimoroni/blinkt/blob/master/examples/pulse.py
-def make_gaussian(fwhm):
-    x = np.arange(0, blinkt.NUM_PIXELS, 1, float)
-    y = x[:, np.newaxis]
-    x0, y0 = 3.5, 3.5
-    fwhm = fwhm
-    gauss = np.exp(-4 * np.log(2) * ((x - x0) ** 2 + (y - y0) ** 2) / fwhm ** 2)
-    return gauss
-
-
-while True:
-    for z in list(range(1, 10)[::-1]) + list(range(1, 10)):
-        fwhm = 5.0 / z
-        gauss = make_gaussian(fwhm)
-        start = time.time()
-        y = 4
-
-        for x in range(blinkt.NUM_PIXELS):
-            h = hsv[0] # Hue (°)
-            s = hsv[1] # Saturation (%)
-            v = gauss[x, y] # Value (%)
-            rgb = colorsys.hsv_to_rgb(h, s, v)
-            r, g, b = [int(255.0 * i) for i in rgb]
-            blinkt.set_pixel(x, r, g, b)
-
-        blinkt.show()
-        end = time.time()
-        t = end - start
 
-        if t < 0.04:
-            time.sleep(0.04 - t)
+# The whole pulse cycle is computed once, afterwards the frames are just replayed
+color = tuple(float(x) for x in args.color.split(','))
+play_frames(pulse_frames(color, args.brightness))
@@ -24,10 +24,29 @@
 
 
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
 import os.path
 import shutil
 import subprocess
 import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+try:
+    import segno
+except ImportError:
+    segno = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 
 # Parse the command line arguments
@@ -35,11 +54,22 @@ arg_parser = argparse.ArgumentParser(description='Generates an HTML page contain
 arg_parser.add_argument('--input', help='the file containing the list of commands and songs to generate')
 arg_parser.add_argument('--generate-images', action='store_true', help='generate an individual PNG image for each card')
 arg_parser.add_argument('--print-dublex', action='store_true', help='generate cards optimized for duplex print', default=False)
+arg_parser.add_argument('--rebuild', action='store_true', help='generate all cards again (by default only new or changed cards are generated)', default=False)
+arg_parser.add_argument('--dpi', default=300, type=int, help='the resolution the cards are printed at (the images are sized for it)')
+arg_parser.add_argument('--qr-format', default='png', choices=['png', 'svg'], help='the image format of the QR codes')
+arg_parser.add_argument('--art-quality', default=85, type=int, help='the JPEG quality (1 to 95) of the resized artworks (requires Pillow)')
+arg_parser.add_argument('--jobs', default=8, type=int, help='number of QR codes, artworks and card images generated at the same time')
+arg_parser.add_argument('--art-cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'dinoqode', 'artwork'), help='the directory downloaded artworks are kept in')
+arg_parser.add_argument('--art-cache-size', default=200, type=int, help='maximum size of the artwork cache in MB (least recently used artworks are removed first)')
 args = arg_parser.parse_args()
 print(args)
 
 
-def process_command(line, index):
+# A card of the input file: the code of the QR code, the URL of the artwork and the labels
+Card = collections.namedtuple('Card', ['qrcode', 'arturl', 'song', 'album', 'artist', 'service'])
+
+
+def process_command(line):
     split = re.split('\\|', line)
 
     if line.startswith('cmd:say'):
@@ -49,55 +79,25 @@ def process_command(line, index):
     else:
         (cmdname, arturl, qrcode) = (split[1], split[2], split[0])
 
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.png'.format(index)
-
-    # Create a QR code from the command URI
-    print(subprocess.check_output(['qrencode', '-s', '100', '-o', qrout, qrcode]))
-
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    return Card(qrcode, arturl, cmdname, None, None, None)
 
-    return (cmdname, None, None)
 
-
-def process_tunein(line, index):
+def process_tunein(line):
     split = re.split('\\|', line)
 
     (cmdname, arturl, qrcode) = (split[1], split[2], split[0])
 
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.png'.format(index)
-
-    # Create a QR code from the command URI
-    print(subprocess.check_output(['qrencode', '-s', '100', '-o', qrout, qrcode]))
-
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    return Card(qrcode, arturl, cmdname, None, None, None)
 
-    return (cmdname, None, None)
-
-def process_playlist_favorite(line, index):
+def process_playlist_favorite(line):
     split = re.split('\\|', line)
 
     (cmdname, arturl, qrcode) = (split[1], split[2], split[0])
 
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.png'.format(index)
-
-    # Create a QR code from the command URI
-    print(subprocess.check_output(['qrencode', '-s', '100', '-o', qrout, qrcode]))
-
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    return Card(qrcode, arturl, cmdname, None, None, None)
 
-    return (cmdname, None, None)
 
-
-def process_track(line, index):
+def process_track(line):
     split = re.split('\\|', line)
 
     service = re.split('\\:', line)[0]
@@ -113,23 +113,281 @@ def process_track(line, index):
         artist = split[3]
         arturl = split[4]
 
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.png'.format(index)
+    return Card(split[0], arturl, song, album, artist, service)
+
+
+# The width (in CSS pixels) of the elements matching the selector in `cards.css`
+def css_width(selector):
+    with open('cards/cards.css') as f:
+        css = f.read()
+
+    for rule in re.finditer(r'^' + re.escape(selector) + r'\s*\{([^}]*)\}', css, re.MULTILINE):
+        width = re.search(r'(?:^|;|\s)width:\s*([0-9.]+)px', rule.group(1))
+        if width:
+            return float(width.group(1))
+    raise ValueError('No width for {0} in cards.css'.format(selector))
+
+
+# The number of image pixels needed to print CSS pixels (1/96 inch) at `--dpi`
+def print_pixels(css_pixels):
+    return int(math.ceil(css_pixels / 96.0 * args.dpi))
 
-    # Create a QR code from the track URI
-    print(subprocess.check_output(['qrencode', '-s', '100', '-o', qrout, split[0]]))
 
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+# Quiet zone around the QR codes (in modules)
+QR_BORDER = 4
+# The modules of the QR codes are printed at least this large (in mm), the highest error
+# correction level that allows it is used
+QR_MIN_MODULE_SIZE = 0.5
+# Bytes that fit into the QR code versions 1 to 10 per error correction level (to size the
+# QR codes of `qrencode`, which is used if `segno` isn't installed)
+QR_CAPACITY = {
+    'H': [7, 14, 24, 34, 44, 58, 64, 84, 98, 119],
+    'Q': [11, 20, 32, 46, 60, 74, 86, 108, 130, 151],
+    'M': [14, 26, 42, 62, 84, 106, 122, 152, 180, 213],
+    'L': [17, 32, 53, 78, 106, 134, 154, 192, 230, 271]
+}
+
+
+def qrcode_filename(name):
+    return '{0}qr.{1}'.format(name, args.qr_format)
+
+
+# The error correction level, the QR code (if `segno` is installed) and its side length in
+# modules (including the quiet zone)
+def qrcode_layout(qrcode, width):
+    for level in 'HQML':
+        if segno is not None:
+            symbol = segno.make_qr(qrcode, error=level, boost_error=False)
+            modules = symbol.symbol_size(border=QR_BORDER)[0]
+        else:
+            symbol = None
+            length = len(qrcode.encode('utf-8'))
+            version = next((version for version, capacity in enumerate(QR_CAPACITY[level], 1) if capacity >= length), len(QR_CAPACITY[level]) + 1)
+            modules = 17 + 4 * version + 2 * QR_BORDER
 
-    return (song, album, artist, service)
+        if width / 96.0 * 25.4 / modules >= QR_MIN_MODULE_SIZE:
+            break
+
+    return level, symbol, modules
+
+
+# Create a QR code from the command/track URI. PNGs get a whole number of pixels per module
+# and are about as large as the QR code (`width` CSS pixels) is printed at `--dpi`.
+def generate_qrcode(qrcode, name, width):
+    qrout = os.path.join('out', qrcode_filename(name))
+    level, symbol, modules = qrcode_layout(qrcode, width)
+    scale = max(print_pixels(width) // modules, 1) if args.qr_format == 'png' else 1
+
+    if symbol is not None:
+        symbol.save(qrout, kind=args.qr_format, scale=scale, border=QR_BORDER)
+    else:
+        print(subprocess.check_output(['qrencode', '-l', level, '-s', str(scale), '-m', str(QR_BORDER),
+                                       '-t', args.qr_format.upper(), '-o', qrout, qrcode]))
+
+
+# Raised if an artwork can neither be downloaded nor taken from the cache
+class ArtworkUnavailable(Exception):
+    pass
+
+
+# Persistent cache of the downloaded artworks. The artworks are stored by the hash of their
+# content (identical covers are stored once), `index.json` maps the URLs to the hashes and
+# keeps the `ETag`/`Last-Modified` headers. A cached artwork is revalidated once per run,
+# it's only downloaded again if it changed. If the cache grows larger than `max_size`
+# bytes, the least recently used artworks are removed.
+#
+# If Pillow is installed, the artworks are resized to the size they are printed at and
+# re-encoded as JPEG; the resized artworks are kept in the cache too.
+class ArtworkCache:
+    USER_AGENT = 'dinoqode'
+    TIMEOUT = 30
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects = os.path.join(directory, 'objects')
+        self.resized = os.path.join(directory, 'resized')
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._url_locks = collections.defaultdict(threading.Lock)
+        self._path_locks = collections.defaultdict(threading.Lock)
+        self._validated = set()
+        self.stats = collections.Counter()
+
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.resized, exist_ok=True)
+        try:
+            with open(self.index_path) as index_file:
+                self._index = json.load(index_file)
+        except (OSError, ValueError):
+            self._index = {}
+
+    # The stats are counted by several threads
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    # Returns the path of the cached artwork of the URL
+    def get(self, url):
+        # Download an artwork used by several cards only once
+        with self._lock:
+            url_lock = self._url_locks[url]
+
+        with url_lock:
+            with self._lock:
+                entry = self._index.get(url)
+            if entry and not os.path.exists(self.object_path(entry['hash'])):
+                entry = None
+
+            if entry and url in self._validated:
+                self.count('shared')
+            else:
+                entry = self._fetch(url, entry)
+
+            with self._lock:
+                entry['used'] = time.time()
+                self._index[url] = entry
+                self._validated.add(url)
+
+            return self.object_path(entry['hash'])
+
+    # Returns the path of the cached artwork of the URL, resized to fit into `size` x `size`
+    # pixels (smaller artworks aren't enlarged) and encoded as JPEG
+    def get_resized(self, url, size, quality):
+        digest = os.path.basename(self.get(url))
+        path = os.path.join(self.resized, '{0}-{1}-{2}.jpg'.format(digest, size, quality))
+
+        # Resize an artwork used by several cards only once
+        with self._lock:
+            path_lock = self._path_locks[path]
+
+        with path_lock:
+            if not os.path.exists(path):
+                self._resize(digest, path, size, quality)
+        return path
+
+    def _resize(self, digest, path, size, quality):
+        with Image.open(self.object_path(digest)) as image:
+            # Let the JPEG decoder skip the resolution that isn't needed
+            image.draft('RGB', (size, size))
+            if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image)
+                image = background
+            else:
+                image = image.convert('RGB')
+            image.thumbnail((size, size), Image.LANCZOS)
+
+            temp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+            image.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(temp_path, path)
+
+        self.count('resized')
+
+    def _fetch(self, url, entry):
+        request = urllib.request.Request(url, headers={'User-Agent': ArtworkCache.USER_AGENT})
+        if entry and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            with urllib.request.urlopen(request, timeout=ArtworkCache.TIMEOUT) as response:
+                data = response.read()
+                headers = response.headers
+        except (urllib.error.URLError, OSError) as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 304 and entry:
+                self.count('revalidated')
+                return entry
+
+            # Offline or the artwork is gone (e.g. 404): use the cached artwork
+            if entry:
+                print('Cannot revalidate artwork ({0}), using the cached one: {1}'.format(e, url))
+                self.count('offline')
+                return entry
+
+            self.count('failed')
+            raise ArtworkUnavailable('{0}: {1}'.format(e, url)) from e
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            temp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+            with open(temp_path, 'wb') as object_file:
+                object_file.write(data)
+            os.replace(temp_path, path)
+
+        self.count('downloaded')
+        return {'hash': digest, 'size': len(data), 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+
+    # Remove the least recently used artworks (and files that are not in the index, like
+    # the resized versions of removed artworks) until the cache is small enough and save
+    # the index
+    def save(self):
+        with self._lock:
+            objects = {}
+            for entry in self._index.values():
+                used, size = objects.get(entry['hash'], (0, entry['size']))
+                objects[entry['hash']] = (max(used, entry.get('used', 0)), size)
+
+            total = sum(size for _, size in objects.values())
+            for digest, (_, size) in sorted(objects.items(), key=lambda item: item[1][0]):
+                if total <= self.max_size:
+                    break
+                del objects[digest]
+                total -= size
+                self.stats['evicted'] += 1
+
+            self._index = {url: entry for url, entry in self._index.items() if entry['hash'] in objects}
+            for name in os.listdir(self.objects):
+                if name not in objects:
+                    os.remove(self.object_path(name))
+            for name in os.listdir(self.resized):
+                if name.split('-')[0] not in objects:
+                    os.remove(os.path.join(self.resized, name))
+
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w') as index_file:
+                json.dump(self._index, index_file)
+            os.replace(temp_path, self.index_path)
+
+
+# Link (or copy) a cached file into the output directory
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# The artworks are JPEGs (re-encoded if Pillow is installed, the covers of the music
+# services are JPEGs anyway)
+def artwork_filename(name):
+    return '{0}art.jpg'.format(name)
+
+
+# Fetch the artwork and save to the output directory, resized for the artwork (`width` CSS
+# pixels) printed at `--dpi`
+def fetch_artwork(arturl, name, width):
+    artout = os.path.join('out', artwork_filename(name))
+    try:
+        if Image is not None:
+            link_or_copy(artwork_cache.get_resized(arturl, print_pixels(width), args.art_quality), artout)
+        else:
+            link_or_copy(artwork_cache.get(arturl), artout)
+    except ArtworkUnavailable as e:
+        # The card is generated without the artwork (and again on the next run)
+        print('Skipping artwork, cannot download it ({0})'.format(e))
 
 
 # Return the HTML content for a single card.
-def card_content_html(index, artist, album, song, service):
-    qrimg = '{0}qr.png'.format(index)
-    artimg = '{0}art.png'.format(index)
+def card_content_html(name, artist, album, song, service):
+    qrimg = qrcode_filename(name)
+    artimg = artwork_filename(name)
     serviceimg = '{0}.png'.format(service)
 
     html = ''
@@ -151,7 +409,7 @@ def card_content_html(index, artist, album, song, service):
 
 
 # Generate a PNG version of an individual card (with no dashed lines).
-def generate_individual_card_image(index, artist, album, song, service):
+def generate_individual_card_image(name, artist, album, song, service):
     # First generate an HTML file containing the individual card
     html = '''
 <!DOCTYPE html>
@@ -162,26 +420,87 @@ def generate_individual_card_image(index, artist, album, song, service):
 <body>
   <div class="card">
 '''
-    html += card_content_html(index, artist, album, song, service)
+    html += card_content_html(name, artist, album, song, service)
     html += '''
 </div>
 </body>
 </html>
 '''
 
-    html_filename = 'out/{0}.html'.format(index)
+    html_filename = 'out/{0}.html'.format(name)
     with open(html_filename, 'w') as f:
         f.write(html)
 
     # Then convert the HTML to a PNG image (beware the hardcoded values; these need to align
     # with the dimensions in `cards.css`)
-    png_filename = 'out/{0}'.format(index)
+    png_filename = 'out/{0}'.format(name)
     print(subprocess.check_output(['webkit2png', html_filename, '--scale=1.0', '--clipped', '--clipwidth=720', '--clipheight=640', '--delay=2' ,'-o', png_filename]))
 
     # Rename the file to remove the extra `-clipped` suffix that `webkit2png` includes by default
     os.rename(png_filename + '-clipped.png', png_filename + 'card.png')
 
 
+# Files of the output directory that are not generated per card
+STATIC_FILES = ['cards.css', 'amazonmusic.png', 'applemusic.png', 'spotify.png', 'aldilife.png', 'napster.png', 'lib.png']
+MANIFEST_FILE = 'manifest.json'
+
+# Increase when the generated files of a card change (e.g. the HTML of a card)
+TEMPLATE_VERSION = 1
+
+
+# The generated files of a card are named after a hash of everything they depend on: the
+# input line, the logo shown on the card, the template version, `cards.css` (the images
+# are sized for it) and the options changing the images
+def card_name(line, service, template):
+    return hashlib.sha1('\n'.join([line, service or '', template]).encode('utf-8')).hexdigest()[:16]
+
+
+def card_files(name):
+    files = [qrcode_filename(name), artwork_filename(name)]
+    if args.generate_images:
+        files += ['{0}.html'.format(name), '{0}card.png'.format(name)]
+    return files
+
+
+# The manifest lists the cards in the output directory (by name) with their input line,
+# their files and their HTML, so cards that didn't change aren't generated again
+def load_manifest(template):
+    try:
+        with open(os.path.join('out', MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if args.rebuild or manifest.get('template') != template:
+        return {}
+    return manifest.get('cards', {})
+
+
+def save_manifest(template, cards):
+    temp_path = os.path.join('out', MANIFEST_FILE + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump({'template': template, 'cards': cards}, f, indent=1, ensure_ascii=False)
+    os.replace(temp_path, os.path.join('out', MANIFEST_FILE))
+
+
+# Remove the files of cards that are no longer in the input
+def collect_garbage(cards):
+    keep = set(STATIC_FILES + [MANIFEST_FILE, 'index.html'])
+    for entry in cards.values():
+        keep.update(entry['files'])
+
+    removed = 0
+    for name in os.listdir('out'):
+        if name not in keep:
+            path = os.path.join('out', name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
+    return removed
+
+
 def generate_cards():
     service = ''
     duplex = args.print_dublex
@@ -205,16 +524,64 @@ def generate_cards():
     dirname = os.getcwd()
     outdir = os.path.join(dirname, 'out')
     print(outdir)
-    if os.path.exists(outdir):
-        shutil.rmtree(outdir)
-    os.mkdir(outdir)
+    os.makedirs(outdir, exist_ok=True)
 
     # Read the file containing the list of commands and songs to generate
     with open(args.input) as f:
         lines = f.readlines()
 
-    # The index of the current item being processed
-    index = 0
+    cards = []
+    for line in lines:
+        # Trim newline
+        line = line.strip()
+
+        # Remove any trailing comments and newline (and ignore any empty or comment-only lines)
+        line = line.split('#')[0]
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('cmd:'):
+            cards.append((line, process_command(line)))
+        elif line.startswith('applemusic:') or line.startswith('amazonmusic:') or line.startswith('spotify:') or  line.startswith('aldilife:') or line.startswith('napster:') or line.startswith('lib:') :
+            cards.append((line, process_track(line)))
+        elif line.startswith('tunein:'):
+            cards.append((line, process_tunein(line)))
+        elif line.startswith('favorite:') or line.startswith('playlist:'):
+            cards.append((line, process_playlist_favorite(line)))
+        else:
+            print('Failed to handle URI: ' + line)
+
+    with open('cards/cards.css', 'rb') as f:
+        template = ':'.join(str(value) for value in [TEMPLATE_VERSION, hashlib.sha1(f.read()).hexdigest()[:16],
+                                                        int(args.generate_images), args.dpi, args.qr_format,
+                                                        int(Image is not None), args.art_quality])
+
+    # Cards without a service show the logo of the previous card
+    names = []
+    services = []
+    for line, card in cards:
+        service = card.service or service
+        services.append(service)
+        names.append(card_name(line, service, template))
+
+    # Only generate the cards that are new, changed or have missing files
+    built = load_manifest(template)
+    manifest = {}
+    new_cards = []
+    for (line, card), name, service in zip(cards, names, services):
+        if name in manifest:
+            continue
+
+        entry = built.get(name)
+        if entry and all(os.path.exists(os.path.join('out', file)) for file in entry['files']):
+            manifest[name] = entry
+        else:
+            manifest[name] = {'line': line, 'files': card_files(name),
+                              'html': card_content_html(name, card.artist, card.album, card.song, service)}
+            new_cards.append((name, card, service))
+
+    print('Cards: {0} to generate, {1} unchanged'.format(len(new_cards), len(cards) - len(new_cards)))
 
     # Copy the CSS file into the output directory.  (Note the use of 'page-break-inside: avoid'
     # in `cards.css`; this prevents the card divs from being spread across multiple pages
@@ -240,37 +607,50 @@ def generate_cards():
     else:
         html += '<body>'
 
-    for line in lines:
-        # Trim newline
-        line = line.strip()
-
-        # Remove any trailing comments and newline (and ignore any empty or comment-only lines)
-        line = line.split('#')[0]
-        line = line.strip()
-        if not line:
-            continue
-
-        if line.startswith('cmd:'):
-            (song, album, artist) = process_command(line, index)
-        elif line.startswith('applemusic:') or line.startswith('amazonmusic:') or line.startswith('spotify:') or  line.startswith('aldilife:') or line.startswith('napster:') or line.startswith('lib:') :
-            (song, album, artist, service) = process_track(line, index)
-        elif line.startswith('tunein:'):
-            (song, album, artist) = process_tunein(line, index)
-        elif line.startswith('favorite:') or line.startswith('playlist:'):
-            (song, album, artist) = process_playlist_favorite(line, index)
-        else:
-            print('Failed to handle URI: ' + line)
-            continue
-
+    # Cards are only added to the manifest when all of their files are generated
+    pending = set(name for name, _, _ in new_cards)
+    done = {name: entry for name, entry in manifest.items() if name not in pending}
+    try:
+        # Generate the QR codes and fetch the artworks of all cards at the same time (the
+        # card images need both)
+        with concurrent.futures.ThreadPoolExecutor(max(args.jobs, 1)) as executor:
+            qrcode_width = css_width('.qrcode')
+            images = [executor.submit(generate_qrcode, card.qrcode, name, qrcode_width) for name, card, _ in new_cards]
+            artwork_width = css_width('.art')
+            images += [executor.submit(fetch_artwork, card.arturl, name, artwork_width) for name, card, _ in new_cards]
+            try:
+                for future in images:
+                    future.result()
+            finally:
+                # Saving removes cached files that are not in the index yet, no download may
+                # still be running
+                for future in images:
+                    future.cancel()
+                concurrent.futures.wait(images)
+                artwork_cache.save()
+
+            print('Artworks: {downloaded} downloaded, {revalidated} unchanged, {shared} shared, {offline} not revalidated, {failed} failed, {resized} resized, {evicted} evicted from the cache'.format(
+                **{key: artwork_cache.stats[key] for key in ('downloaded', 'revalidated', 'shared', 'offline', 'failed', 'resized', 'evicted')}))
+
+            if args.generate_images:
+                # Also generate an individual PNG for each card
+                card_images = [executor.submit(generate_individual_card_image, name, card.artist, card.album, card.song, service)
+                               for name, card, service in new_cards]
+                for future in card_images:
+                    future.result()
+
+        done = manifest
+    finally:
+        save_manifest(template, done)
+
+    print('Removed {0} files of old cards'.format(collect_garbage(manifest)))
+
+    for index, name in enumerate(names):
         # Append the HTML for this card
         cardhtml = '<div class="card">\n'
-        cardhtml += card_content_html(index, artist, album, song, service)
+        cardhtml += manifest[name]['html']
         cardhtml += '</div>\n'
 
-        if args.generate_images:
-            # Also generate an individual PNG for the card
-            generate_individual_card_image(index, artist, album, song, service)
-
         if duplex:
             if index % 4 == 3:
                 cardhtml += '<br style="clear: both;"/>\n'
@@ -286,8 +666,6 @@ def generate_cards():
             if index % 12 == 11:
                 html += print_card_back()
 
-        index += 1
-
     html += print_card_back()
     html += '</body>\n'
     html += '</html>\n'
@@ -298,4 +676,5 @@ def generate_cards():
         f.write(html)
 
 
+artwork_cache = ArtworkCache(args.art_cache, args.art_cache_size * 1024 * 1024)
 generate_cards()
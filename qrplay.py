@@ -24,24 +24,39 @@
 
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
+import functools
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import select
+import shlex
+import signal
+import socketserver
 import subprocess
-from time import sleep
+import sys
+import threading
+from time import monotonic, sleep, time
 import urllib.parse
-import urllib.request
 import http.client
-import re
-import traceback
+import http.server
+import qrprofile
+
+# Used to measure the time until the scanner is ready
+started_at = monotonic()
 
 try:
     use_blinkt = True
-    print('use_blinkt = True')
     import blinkt
+    import blinkt_led_frames
     blinkt.set_clear_on_exit(True)
 except ImportError:
     use_blinkt = False
-    print('use_blinkt = False')
 
 
 # Parse the command line arguments
@@ -50,327 +65,1698 @@ arg_parser.add_argument('--default-volume', default='25', help='the volume of yo
 arg_parser.add_argument('--default-device', default='Büro', help='the name of your default device/room')
 arg_parser.add_argument('--hostname', default='0.0.0.0', help='the hostname or IP address of the machine running `node-sonos-http-api`')
 arg_parser.add_argument('--skip-load', action='store_true', help='skip loading of the music library (useful if the server has already loaded it)', default=True)
+arg_parser.add_argument('--port', default=5005, type=int, help='the port of `node-sonos-http-api`')
 arg_parser.add_argument('--debug-file', help='read commands from a file instead of launching scanner')
+arg_parser.add_argument('--debug-interval', default=10.0, type=float, help='seconds between the codes of the debug file (0: as fast as possible)')
+arg_parser.add_argument('--benchmark', action='store_true', help='report the throughput and latency of the codes of the debug file', default=False)
+arg_parser.add_argument('--stub', action='store_true', help='send the requests to a local stub of `node-sonos-http-api` (see `sonos_stub.py`) instead', default=False)
+arg_parser.add_argument('--stub-latency', default=0.0, type=float, help='seconds every request to the stub takes')
+arg_parser.add_argument('--stub-jitter', default=0.0, type=float, help='maximum random seconds added to the latency of the stub')
+arg_parser.add_argument('--stub-error-rate', default=0.0, type=float, help='share of the requests to the stub that fail (0 to 1)')
 arg_parser.add_argument('--speak-welcome', action='store_true', help='should dinoqode speak welcome messages on startup', default=False)
+arg_parser.add_argument('--connect-timeout', default=2.0, type=float, help='seconds to wait for a connection to `node-sonos-http-api`')
+arg_parser.add_argument('--read-timeout', default=15.0, type=float, help='seconds to wait for a response of `node-sonos-http-api`')
+arg_parser.add_argument('--request-deadline', default=8.0, type=float, help='maximum seconds a request to `node-sonos-http-api` may take (including retries)')
+arg_parser.add_argument('--retries', default=2, type=int, help='number of retries of a request that couldn\'t reach `node-sonos-http-api`')
+arg_parser.add_argument('--retry-backoff', default=0.25, type=float, help='seconds to wait before the first retry (doubled for every retry, randomized)')
+arg_parser.add_argument('--breaker-threshold', default=3, type=int, help='number of failed requests in a row after which `node-sonos-http-api` is considered unavailable')
+arg_parser.add_argument('--breaker-reset', default=10.0, type=float, help='seconds until an unavailable `node-sonos-http-api` is tried again')
+arg_parser.add_argument('--replay-window', default=120.0, type=float, help='seconds a song/album card that failed because `node-sonos-http-api` was unreachable is replayed when it is available again (0 to disable)')
+arg_parser.add_argument('--queue-size', default=8, type=int, help='maximum number of scanned codes waiting to be handled')
+arg_parser.add_argument('--queue-policy', default='coalesce', choices=['drop-oldest', 'coalesce'], help='what to do with codes scanned while others are still waiting (`coalesce` ignores codes that are already waiting, both drop the oldest code if the queue is full)')
+arg_parser.add_argument('--item-window', default=30.0, type=float, help='seconds a song/album card is ignored after it was scanned (every detection restarts the window)')
+arg_parser.add_argument('--command-window', default=1.0, type=float, help='seconds a command card is ignored after it was scanned (every detection restarts the window)')
+arg_parser.add_argument('--coalesce-window', default=0.5, type=float, help='seconds repeated relative commands (e.g. `cmd:volume:+5`) are added up before they are sent')
+arg_parser.add_argument('--scanner-command', default='/usr/bin/zbarcam --prescale=500x500 --nodisplay', help='the command that runs the QR code scanner')
+arg_parser.add_argument('--scanner-backend', default='zbarcam', choices=['zbarcam', 'inprocess', 'none'], help='decode QR codes with `zbarcam` or in-process (see `qrscan.py`, requires OpenCV), `none` to only accept codes from the control socket')
+arg_parser.add_argument('--scanner-source', default='/dev/video0', help='in-process scanner: camera device, video file or directory of recorded frames')
+arg_parser.add_argument('--scanner-max-size', default=500, type=int, help='in-process scanner: maximum size (in pixels) frames are decoded at')
+arg_parser.add_argument('--scanner-fps', default=None, type=float, help='in-process scanner: maximum number of frames per second')
+arg_parser.add_argument('--idle-after', default=300.0, type=float, help='seconds without a scanned card (or a change in front of the camera) before the scanner switches to low-power scanning (0 to disable)')
+arg_parser.add_argument('--idle-fps', default=2.0, type=float, help='frames per second (zbarcam: scan periods per second) in low-power scanning mode')
+arg_parser.add_argument('--state-file', default='.dinoqode-state.json', help='the file the last used room, play mode and scanned codes are saved in')
+arg_parser.add_argument('--config', help='JSON file with several scanners, each with its own room and play mode (see `stations.example.json`)')
+arg_parser.add_argument('--zone-refresh', default=15.0, type=float, help='seconds between reloading the state of the Sonos rooms (0 to disable)')
+arg_parser.add_argument('--zone-max-age', default=20.0, type=float, help='seconds the cached state of a Sonos room is used to skip requests that change nothing (0 to disable)')
+arg_parser.add_argument('--metrics-port', default=0, type=int, help='port of the metrics endpoint (Prometheus text format, 0 to disable)')
+arg_parser.add_argument('--metrics-address', default='127.0.0.1', help='address the metrics endpoint listens on')
+arg_parser.add_argument('--webhook-port', default=0, type=int, help='port to receive the webhook events of `node-sonos-http-api` on (0 to disable)')
+arg_parser.add_argument('--webhook-address', default='127.0.0.1', help='address the webhook listens on (only `node-sonos-http-api` should be able to post events)')
+arg_parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'warning', 'error'], help='the minimum level of the log output (`debug` also logs the responses of `node-sonos-http-api`)')
+arg_parser.add_argument('--log-ring-size', default=1000, type=int, help='number of recent log events (at `--log-level`) kept in memory (0 to disable)')
+arg_parser.add_argument('--log-dump-file', default='/tmp/dinoqode-events.log', help='the file the recent log events are written to on SIGUSR1')
+arg_parser.add_argument('--profile-dir', default='/tmp', help='the directory profiles and memory reports are written to (see `qrprofile.py`)')
+arg_parser.add_argument('--profile-interval', default=0.005, type=float, help='seconds between the samples of the profiler')
+arg_parser.add_argument('--control-socket', help='path of a Unix socket to send codes to and query the state (see `ControlHandler`)')
+arg_parser.add_argument('--control-port', default=0, type=int, help='localhost port of the control socket (0 to disable)')
 args = arg_parser.parse_args()
-print(args)
 
-current_device = args.default_device
+# Logs `EVENT key=value ...` records. The records are put into a queue and written by a
+# background thread, so the scanner and dispatcher threads never wait for the log output.
+class EventLogger:
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
 
-# Call http request
-def perform_request(url):
-    global last_qrcode_success
+    def log(self, level, event, fields, exc_info=False):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={'fields': fields}, exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        self.log(logging.ERROR, event, fields, exc_info)
+
+
+class EventFormatter(logging.Formatter):
+    @staticmethod
+    def format_value(value):
+        if isinstance(value, float):
+            value = '{0:.4g}'.format(value)
+        value = str(value)
+        if not value or any(char in value for char in ' "=\n'):
+            return json.dumps(value, ensure_ascii=False)
+        return value
+
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if not fields:
+            return message
+
+        text = ' '.join('{0}={1}'.format(key, EventFormatter.format_value(value)) for key, value in fields.items())
+        head, _, tail = message.partition('\n')
+        return head + ' ' + text + ('\n' + tail if tail else '')
+
+
+# Puts the records into the queue as they are (the default handler formats the record in
+# the logging thread)
+class EventQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Writes the records without flushing, the listener flushes when the queue is empty, so a
+# burst of records needs only one write
+class BufferedStreamHandler(logging.StreamHandler):
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
 
-    print(url)
+
+class EventListener(logging.handlers.QueueListener):
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+# Keeps the most recent records in memory, see `dump()`
+class RingBufferHandler(logging.Handler):
+    def __init__(self, capacity):
+        super().__init__(logging.DEBUG)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, path):
+        with self.lock:
+            records = list(self.records)
+        try:
+            with open(path, 'w') as dump_file:
+                for record in records:
+                    dump_file.write(self.format(record) + '\n')
+            log.info('LOG EVENTS DUMPED', path=path, events=len(records))
+        except OSError as e:
+            log.error('CANNOT DUMP LOG EVENTS', path=path, error=e)
+
+
+log_queue_handler = EventQueueHandler(queue.SimpleQueue())
+logging.getLogger().addHandler(log_queue_handler)
+
+# A buffered stream of its own (`python3 -u` would make every write a system call)
+log_stream = open(sys.stdout.fileno(), 'w', buffering=65536, encoding='utf-8', closefd=False)
+log_output = BufferedStreamHandler(log_stream)
+log_output.setLevel(args.log_level.upper())
+log_output.setFormatter(EventFormatter('%(levelname)s %(threadName)s %(message)s'))
+log_handlers = [log_output]
+
+if args.log_ring_size > 0:
+    log_ring = RingBufferHandler(args.log_ring_size)
+    log_ring.setFormatter(EventFormatter('%(asctime)s %(levelname)s %(threadName)s %(message)s'))
+    log_handlers.append(log_ring)
+
+    # Dump the recent events with `kill -USR1 <pid>`
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=log_ring.dump, args=[args.log_dump_file]).start())
+
+# Records below the level are not even created (see `EventLogger.log()`)
+logging.getLogger().setLevel(args.log_level.upper())
+log_listener = EventListener(log_queue_handler.queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# systemd stops `qrplay` with SIGTERM, which would end it without running the `atexit`
+# handlers (pending state changes and log records would be lost)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+log = EventLogger('qrplay')
+log.debug('ARGUMENTS', **vars(args))
+log.info('BLINKT', enabled=use_blinkt)
+
+# In-memory counters and latency histograms of the scan path, rendered in the text format
+# of Prometheus (see `--metrics-port`). Values are kept per label set, e.g.
+# `metrics.observe('dinoqode_request_seconds', 0.05, endpoint='pause')`.
+class Metrics:
+    # Upper bounds of the histogram buckets (in seconds)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = collections.OrderedDict()
+        self._values = collections.defaultdict(dict)
+        self._callbacks = {}
+
+    def describe(self, name, kind, text, callback=None):
+        self._descriptions[name] = (kind, text)
+        if callback:
+            self._callbacks[name] = callback
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                # Counts per bucket, sum, count
+                histogram = self._values[name][key] = [0] * len(Metrics.BUCKETS) + [0.0, 0]
+
+            for index, bound in enumerate(Metrics.BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('{0}="{1}"'.format(key, escape(value)) for key, value in labels) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, text) in self._descriptions.items():
+                lines.append('# HELP {0} {1}'.format(name, text))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+
+                if name in self._callbacks:
+                    lines.append('{0} {1}'.format(name, self._callbacks[name]()))
+                    continue
+
+                for labels, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('{0}{1} {2}'.format(name, Metrics.format_labels(labels), value))
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(Metrics.BUCKETS + ('+Inf',), value[:len(Metrics.BUCKETS)] + [value[-1]]):
+                        cumulative = count if bound == '+Inf' else cumulative + count
+                        lines.append('{0}_bucket{1} {2}'.format(name, Metrics.format_labels(labels, [('le', bound)]), cumulative))
+                    lines.append('{0}_sum{1} {2}'.format(name, Metrics.format_labels(labels), value[-2]))
+                    lines.append('{0}_count{1} {2}'.format(name, Metrics.format_labels(labels), value[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Serves the metrics (profiling is started and stopped with SIGUSR2 and the control socket,
+# the metrics port may be reachable from the network)
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ('/', '/metrics'):
+            body = metrics.render().encode('utf-8')
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The connection to the server couldn't be opened (the request wasn't sent, so it is
+# safe to try again)
+class ConnectFailed(ConnectionError):
+    pass
+
+
+# Pool of persistent (HTTP/1.1 keep-alive) connections to `node-sonos-http-api`, so
+# the requests of a card don't have to open a new TCP connection each time
+class ConnectionPool:
+    def __init__(self, host, port, size=4, connect_timeout=2.0, read_timeout=15.0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self, timeout):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=min(self.connect_timeout, timeout))
+        try:
+            conn.connect()
+        except OSError as e:
+            conn.close()
+            raise ConnectFailed(e) from e
+        return conn
+
+    def _acquire(self, timeout):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or not ConnectionPool.is_dropped(conn):
+                break
+            conn.close()
+
+        reused = conn is not None
+        if not reused:
+            conn = self._connect(timeout)
+
+        conn.sock.settimeout(min(self.read_timeout, timeout))
+        return conn, reused
+
+    # True if the server closed an idle connection (it is readable: end of file)
+    @staticmethod
+    def is_dropped(conn):
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    # Perform a GET request and return the status code and the body of the response. The
+    # connect and read timeouts are limited to `timeout` seconds.
+    #
+    # Only a request that couldn't be sent is sent again (or raises `ConnectFailed`). If the
+    # connection fails after the request was sent, the server may have performed it, the
+    # error is raised.
+    def get(self, path, timeout=None):
+        timeout = max(timeout, 0.001) if timeout is not None else self.read_timeout
+        while True:
+            conn, reused = self._acquire(timeout)
+            try:
+                conn.request('GET', path)
+            except ConnectionError as e:
+                conn.close()
+                # The server closed an idle connection, try again with another one
+                if reused:
+                    continue
+                raise ConnectFailed(e) from e
+            except BaseException:
+                conn.close()
+                raise
+
+            try:
+                response = conn.getresponse()
+                body = response.read()
+            except BaseException:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+
+            return response.status, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# Raised instead of calling `node-sonos-http-api` while it is known to be unreachable
+class SonosUnavailable(IOError):
+    pass
+
+
+# Circuit breaker for the requests to `node-sonos-http-api`. After `threshold` requests in
+# a row couldn't reach the API, requests fail immediately (instead of waiting for their
+# timeouts) for `reset_after` seconds, then a single request probes if the API is back.
+# `on_recovered` is called when a request reaches the API again after a failure.
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=3, reset_after=10.0, on_recovered=None):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.on_recovered = on_recovered
+        self._lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.reachable = True
+        self.failures = 0
+        self._opened = 0.0
+
+    # True if a request may be sent
+    def allow(self):
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and monotonic() - self._opened >= self.reset_after:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            recovered = not self.reachable
+            if self.state != CircuitBreaker.CLOSED:
+                log.warning('SONOS API AVAILABLE')
+            self.state = CircuitBreaker.CLOSED
+            self.reachable = True
+            self.failures = 0
+
+        if recovered and self.on_recovered:
+            self.on_recovered()
+
+    def failed(self):
+        with self._lock:
+            self.reachable = False
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+                if self.state == CircuitBreaker.CLOSED:
+                    log.warning('SONOS API UNAVAILABLE', failures=self.failures)
+                self.state = CircuitBreaker.OPEN
+                self._opened = monotonic()
+
+    # Probe the API periodically while it is unavailable (so the breaker closes again,
+    # even if no card is shown)
+    def probe_periodically(self, path):
+        while True:
+            sleep(self.reset_after)
+            if self.state != CircuitBreaker.CLOSED:
+                try:
+                    sonos_get(path)
+                except (IOError, http.client.HTTPException):
+                    pass
+
+
+# Perform a request to `node-sonos-http-api` that takes at most `deadline` seconds.
+# Requests that couldn't reach the API are retried with a randomized exponential
+# backoff; requests that might have reached it are not (e.g. `next` must not be sent
+# twice). Returns the status code and the body of the response.
+def sonos_get(path, deadline=None):
+    deadline = monotonic() + (deadline or args.request_deadline)
+    attempt = 0
+
+    while True:
+        if not sonos_breaker.allow():
+            raise SonosUnavailable('node-sonos-http-api is unavailable')
+
+        start = monotonic()
+        try:
+            status, body = sonos_pool.get(path, deadline - monotonic())
+        except ConnectFailed:
+            metrics.inc('dinoqode_request_errors_total', endpoint=request_endpoint(path), error='ConnectFailed')
+            sonos_breaker.failed()
+            delay = random.uniform(0, args.retry_backoff * 2 ** attempt)
+            if attempt >= args.retries or monotonic() + delay >= deadline:
+                raise
+        except (IOError, http.client.HTTPException) as e:
+            metrics.inc('dinoqode_request_errors_total', endpoint=request_endpoint(path), error=type(e).__name__)
+            sonos_breaker.failed()
+            raise
+        else:
+            metrics.observe('dinoqode_request_seconds', monotonic() - start, endpoint=request_endpoint(path))
+            if status >= 400:
+                metrics.inc('dinoqode_request_errors_total', endpoint=request_endpoint(path), error='HTTP {0}'.format(status))
+            sonos_breaker.succeeded()
+            return status, body
+
+        attempt += 1
+        log.info('RETRYING', path=path, attempt=attempt, retries=args.retries, delay_ms=delay * 1000)
+        sleep(delay)
+
+
+# The endpoint of a request path (metrics label), e.g. `pause` for `/Büro/pause`
+def request_endpoint(path):
+    _, segments = ZoneCache.split_path(path)
+    return segments[0] if segments else ''
+
+
+# Remembers the last song, album or playlist card (per station) that failed because its
+# request couldn't reach `node-sonos-http-api` (so it surely wasn't played). When the API
+# is available again, the card is handled again (if it was shown less than `window`
+# seconds ago). A newer card of the station replaces or discards the remembered one.
+class OfflineBuffer:
+    def __init__(self, window=120.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def hold(self, qrcode, station):
+        if self.window > 0:
+            with self._lock:
+                self._pending[station] = (qrcode, monotonic())
+            log.info('BUFFERED UNTIL SONOS IS AVAILABLE', qrcode=qrcode)
+
+    def discard(self, station):
+        with self._lock:
+            self._pending.pop(station, None)
+
+    def replay(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for station, (qrcode, held) in pending.items():
+            if monotonic() - held > self.window:
+                log.info('DISCARDING BUFFERED QRCODE', qrcode=qrcode)
+                continue
+
+            log.info('REPLAYING BUFFERED QRCODE', qrcode=qrcode)
+            command_queue.put(qrcode, station)
+
+
+# Whether the last request of the thread reached `node-sonos-http-api` (set by
+# `request_path`). A request that didn't may have to be sent again, a request that
+# failed otherwise (e.g. a read timeout) may have been performed anyway.
+request_context = threading.local()
+
+
+# Call http request, returns True if the request was successful
+def request_path(path, deadline=None):
+    request_context.reached = True
+    if zone_cache.is_redundant(path):
+        log.info('SKIPPING (NO CHANGE)', path=path)
+        metrics.inc('dinoqode_requests_skipped_total', endpoint=request_endpoint(path))
+        return True
+
+    start = monotonic()
     try:
-        response = urllib.request.urlopen(url)
-        result = response.read().decode('utf-8')
+        status, body = sonos_get(path, deadline)
+        result = body.decode('utf-8')
+        log.info('REQUEST', path=path, status=status, ms=(monotonic() - start) * 1000)
+        log.debug('RESPONSE', path=path, body=result)
+
+        if status >= 400:
+            raise http.client.HTTPException('HTTP status {0}'.format(status))
+
         parsed_json = json.loads(result)
 
         try:
-            if (parsed_json['status'] == 'error'):
-                last_qrcode_success = False
-            else:
-                last_qrcode_success = True
+            success = parsed_json['status'] != 'error'
         except KeyError:
-            last_qrcode_success = True
-            print('Key "status" not found in response - QRCode is marked as successful')
+            # Responses without a status are successful
+            success = True
+
+        if success:
+            zone_cache.applied(path)
+        else:
+            metrics.inc('dinoqode_request_errors_total', endpoint=request_endpoint(path), error='status error')
+            zone_cache.invalidate(path)
+        return success
+    except SonosUnavailable:
+        request_context.reached = False
+        log.warning('REQUEST FAILED', path=path, error='node-sonos-http-api is unavailable')
+        return False
+    except ConnectFailed as e:
+        request_context.reached = False
+        log.warning('REQUEST FAILED', path=path, error=str(e) or type(e).__name__, ms=(monotonic() - start) * 1000)
+        return False
+    except (IOError, ValueError, http.client.HTTPException) as e:
+        log.warning('REQUEST FAILED', path=path, error=str(e) or type(e).__name__, ms=(monotonic() - start) * 1000)
+        return False
+
+# Call http request and remember if it was successful
+def perform_request(path):
+    global last_qrcode_success
+
+    last_qrcode_success = request_path(path)
 
-        print(result)
-    except (IOError, http.client.HTTPException):
-        print('Error')
-        last_qrcode_success = False
 
+def global_path(path):
+    return '/' + path
+
+def room_path(path, room):
+    return '/' + urllib.parse.quote(room) + '/' + path
 
 # Perform global request (run on all rooms)
 def perform_global_request(path):
-    perform_request(base_url + '/' + path)
+    perform_request(global_path(path))
 
 # Perform room specific request
 def perform_room_request(path, room):
-    qdevice = urllib.parse.quote(room)
-    perform_request(base_url + '/' + qdevice + '/' + path)
+    perform_request(room_path(path, room))
 
-# Switch to specific room and save the room in last-device file
-def switch_to_room(room):
-    global current_device
-    global last_qrcode
 
-    last_qrcode = ''
+# A request plan describes the requests of a handler. Requests added with `ordered()`
+# are performed one after the other, requests added with `independent()` don't depend
+# on each other and are performed concurrently. Like a sequence of single requests, the
+# plan is successful if its last request was successful.
+class RequestPlan:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='sonos')
 
-    perform_room_request('pause', current_device)
-    perform_room_request('volume/' + args.default_volume, room)
-    current_device = room
-    with open(".last-device", "w") as device_file:
-        device_file.write(current_device)
+    def __init__(self):
+        self.stages = []
 
-# Perform speak command
-def speak(phrase, room=None):
-    if room is None:
-        room = current_device
+    def ordered(self, *paths):
+        self.stages.extend([path] for path in paths)
+        return self
 
-    print('SPEAKING: \'{0}\''.format(phrase))
-    perform_room_request('say/' + urllib.parse.quote(phrase) + '/de', room)
+    def independent(self, *paths):
+        self.stages.append(list(paths))
+        return self
 
-# Flash led lights (onboard or Blinkt! leds)
-def blink_led(type):
-    if use_blinkt == True:
-        # Causes the Blinkt! led bar to blink
-        if type == 'pulse-green':
-            blinkt_subp = subprocess.Popen(["/usr/bin/python", os.path.join(current_dir, "blinkt_led_pulse.py"), "--brightness", "1", "--color", "0,128,0"])
-            sleep(8)
-        elif type == 'pulse-red':
-            blinkt_subp = subprocess.Popen(["/usr/bin/python", os.path.join(current_dir, "blinkt_led_pulse.py"), "--brightness", "1", "--color", "255,0,0"])
-            sleep(8)
-        elif type == 'rainbow':
-            blinkt_subp = subprocess.Popen(["/usr/bin/python", os.path.join(current_dir, "blinkt_led_rainbow.py")])
-            sleep(8)
-
-        print('blink_led: ' + type);
-
-        blinkt_subp.kill()
-        sleep(0.0001)
-        blinkt.clear()
-        blinkt.show()
-        sleep(0.0001)
-        blinkt.clear()
-        blinkt.show()
+    # Perform the requests, returns True if the last request was successful
+    def execute(self):
+        success = True
 
-# Handling QR command
-# If QR code is defined the Blinkt! led bar is flashing green otherwise red
-def handle_command(qrcode):
-    global current_playmode
-    global last_qrcode_success
+        for stage in self.stages:
+            if len(stage) == 1:
+                results = [request_path(stage[0])]
+            else:
+                results = list(RequestPlan.executor.map(request_path, stage))
 
-    room = current_device
+            success = results[-1]
 
-    last_qrcode_success = True
+        return success
 
-    print('HANDLING COMMAND: ' + qrcode)
+    # Perform the requests and remember if the plan was successful
+    def run(self):
+        global last_qrcode_success
 
-    if qrcode == 'cmd:playpause':
-        perform_room_request('playpause', room)
-        phrase = None
+        last_qrcode_success = self.execute()
+        return last_qrcode_success
 
-    elif qrcode == 'cmd:next':
-        perform_room_request('next', room)
-        perform_room_request('play', room)
-        phrase = None
+# Cached state of the Sonos rooms (playback state, volume and whether the queue is
+# known to be empty). It is filled from `/zones`, refreshed in the background, updated by
+# the webhook events of `node-sonos-http-api` and by our own successful requests. Requests
+# that wouldn't change anything (e.g. pausing a paused room) are skipped. Values older
+# than `max_age` seconds are not trusted.
+class ZoneCache:
+    def __init__(self, max_age=20.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._rooms = {}
+
+    # Load the state of all rooms
+    def refresh(self):
+        try:
+            status, body = sonos_get('/zones')
+            zones = json.loads(body.decode('utf-8')) if status < 400 else None
+        except (IOError, ValueError, http.client.HTTPException):
+            zones = None
+
+        if not isinstance(zones, list):
+            log.warning('CANNOT LOAD ZONES')
+            return False
+
+        self.update_zones(zones)
+        return True
+
+    def update_zones(self, zones):
+        for zone in zones:
+            for member in zone.get('members', []):
+                self.update_room(member.get('roomName'), member.get('state', {}))
+
+    def update_room(self, room, room_state):
+        if not room:
+            return
+
+        values = {key: room_state[key] for key in ('playbackState', 'volume', 'mute') if key in room_state}
+        track = room_state.get('currentTrack') or {}
+        if room_state.get('playbackState') == 'PLAYING' or track.get('uri'):
+            values['queueEmpty'] = False
+
+        with self._lock:
+            cached = self._rooms.setdefault(room, {})
+            cached.update(values)
+            cached['updated'] = monotonic()
+
+    # Forget the state of the room of a path (or of all rooms)
+    def invalidate(self, path=None):
+        room, _ = ZoneCache.split_path(path) if path else (None, None)
+        with self._lock:
+            if room is None:
+                self._rooms.clear()
+            else:
+                self._rooms.pop(room, None)
+
+    def get(self, room, key):
+        with self._lock:
+            cached = self._rooms.get(room)
+            if cached is None or monotonic() - cached['updated'] > self.max_age:
+                return None
+            return cached.get(key)
+
+    # Returns (room, action segments) of a room request path
+    @staticmethod
+    def split_path(path):
+        segments = path.split('/')[1:]
+        if len(segments) < 2:
+            return None, segments
+        return urllib.parse.unquote(segments[0]), segments[1:]
+
+    # True if the request wouldn't change the state of the room
+    def is_redundant(self, path):
+        room, action = ZoneCache.split_path(path)
+        if room is None:
+            return False
+
+        if action == ['pause']:
+            return self.get(room, 'playbackState') in ('PAUSED_PLAYBACK', 'STOPPED')
+        if action[0] == 'volume' and len(action) == 2 and action[1].isdigit():
+            return self.get(room, 'volume') == int(action[1])
+        if action == ['clearqueue']:
+            return self.get(room, 'queueEmpty') is True
+
+        return False
+
+    # Update the cache after a successful request
+    def applied(self, path):
+        room, action = ZoneCache.split_path(path)
+        if room is None:
+            return
+
+        if action == ['pause']:
+            values = {'playbackState': 'PAUSED_PLAYBACK'}
+        elif action[0] == 'volume' and len(action) == 2 and action[1].isdigit():
+            values = {'volume': int(action[1])}
+        elif action == ['clearqueue']:
+            values = {'queueEmpty': True}
+        elif action[0] == 'say':
+            # The previous state is restored after speaking
+            return
+        else:
+            self.invalidate(path)
+            return
+
+        with self._lock:
+            cached = self._rooms.get(room)
+            if cached is not None:
+                cached.update(values)
+
+    # Handle an event of the `node-sonos-http-api` webhook
+    def handle_event(self, event):
+        data = event.get('data')
+        if event.get('type') == 'topology-change' and isinstance(data, list):
+            self.update_zones(data)
+        elif event.get('type') == 'transport-state' and isinstance(data, dict):
+            self.update_room(data.get('roomName'), data.get('state', {}))
+        elif event.get('type') == 'volume-change' and isinstance(data, dict):
+            self.update_room(data.get('roomName'), {'volume': data.get('newVolume')})
+        elif event.get('type') == 'mute-change' and isinstance(data, dict):
+            self.update_room(data.get('roomName'), {'mute': data.get('newMute')})
+
+    # Refresh the cache periodically
+    def refresh_periodically(self, interval):
+        while True:
+            sleep(interval)
+            self.refresh()
+
+
+# Receives the webhook events of `node-sonos-http-api` (configure `"webhook":
+# "http://localhost:<port>/"` in its `settings.json`). It only listens on localhost by
+# default, as fake events could make `qrplay` skip requests.
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            event = json.loads(self.rfile.read(length).decode('utf-8'))
+            if isinstance(event, dict):
+                zone_cache.handle_event(event)
+        except ValueError:
+            pass
+
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Persistent state (room, play mode, last scanned codes), stored in one JSON file. Changes
+# are written with a short delay, so several changes in a row cause only one write, and
+# atomically (write a temporary file, then rename it), so a power cut can't corrupt the file.
+# Only the store of the single station without `--config` (`legacy`) falls back on the
+# files used before.
+class StateStore:
+    HISTORY_SIZE = 20
+    # Files used before the state file was introduced
+    LEGACY_FILES = {'device': '.last-device', 'playmode': '.last-playmode'}
+
+    def __init__(self, path, default_device, default_playmode, delay=2.0, legacy=False):
+        self.path = path
+        self.delay = delay
+        self.legacy = legacy
+        self._lock = threading.Lock()
+        self._timer = None
+        self._values = {
+            'device': default_device,
+            'playmode': default_playmode,
+            'last_qrcode': '',
+            'history': []
+        }
+
+    # Load the state file (or the legacy files) with a single read, missing values keep
+    # their defaults. Returns the names of the loaded values.
+    def load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                values = json.load(state_file)
+            if not isinstance(values, dict):
+                values = {}
+        except (OSError, ValueError):
+            values = {}
+            if self.legacy:
+                for key, filename in StateStore.LEGACY_FILES.items():
+                    try:
+                        with open(filename, 'r') as legacy_file:
+                            values[key] = legacy_file.read().replace('\n', '')
+                    except OSError:
+                        pass
+
+        loaded = [key for key, value in values.items() if key in self._values and value]
+        with self._lock:
+            self._values.update((key, values[key]) for key in loaded)
+
+        return loaded
+
+    def get(self, key):
+        with self._lock:
+            return self._values[key]
+
+    def update(self, **values):
+        with self._lock:
+            self._values.update(values)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    @property
+    def device(self):
+        return self.get('device')
+
+    @device.setter
+    def device(self, device):
+        self.update(device=device)
+
+    @property
+    def playmode(self):
+        return self.get('playmode')
+
+    @playmode.setter
+    def playmode(self, playmode):
+        self.update(playmode=playmode)
+
+    @property
+    def last_qrcode(self):
+        return self.get('last_qrcode')
+
+    # Remember a handled code
+    def record(self, qrcode, success):
+        with self._lock:
+            history = self._values['history'][-(StateStore.HISTORY_SIZE - 1):]
+        history.append([int(time()), qrcode, success])
+        self.update(last_qrcode=qrcode if success else '', history=history)
+
+    # Write pending changes to the state file
+    def flush(self):
+        with self._lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+            self._timer = None
+            data = json.dumps(self._values, ensure_ascii=False, indent=2)
+
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as state_file:
+                state_file.write(data)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.error('CANNOT WRITE STATE FILE', path=self.path, error=e)
+
+
+# Switch the station to a specific room and remember the room
+def switch_to_room(station, room):
+    # The last item card should be played again in the new room
+    station.scan_filter.forget_class(ScanFilter.ITEM)
+
+    RequestPlan().independent(
+        room_path('pause', station.state.device),
+        room_path('volume/' + station.volume, room)
+    ).run()
+    station.state.device = room
 
-    elif qrcode == 'cmd:previous':
-        perform_room_request('previous', room)
-        phrase = None
+# Perform speak command
+def speak(phrase, room):
+    log.info('SPEAKING', phrase=phrase, room=room)
+    perform_room_request(speak_path(phrase), room)
+
+def speak_path(phrase):
+    return 'say/' + urllib.parse.quote(phrase) + '/de'
+
+LED_EFFECTS = {
+    'pulse-green': lambda: blinkt_led_frames.pulse_frames((0, 128, 0), 1.0),
+    'pulse-red': lambda: blinkt_led_frames.pulse_frames((255, 0, 0), 1.0),
+    'rainbow': lambda: blinkt_led_frames.rainbow_frames(0.1)
+}
+
+# Plays the led animations on a background thread, so the scanner doesn't have to wait
+# until an animation is finished. A new animation replaces the running one immediately.
+class LedAnimator:
+    DURATION = 8.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._effect = None
+        self._until = 0
+
+        # Compute the frame tables up front, so the first animation starts without delay
+        for frame_table in LED_EFFECTS.values():
+            frame_table()
+
+        self._thread = threading.Thread(target=self._run, name='led', daemon=True)
+        self._thread.start()
+
+    # Start an animation (replaces the running animation)
+    def play(self, effect, duration=DURATION):
+        with self._lock:
+            self._effect = effect
+            self._until = monotonic() + duration
+            self._idle.clear()
+        self._changed.set()
+
+    # Cancel the running animation and switch off the leds
+    def stop(self):
+        self.play(None, 0)
+
+    # Block until the running animation is finished
+    def wait(self, timeout=None):
+        return self._idle.wait(timeout)
+
+    def _clear(self):
+        blinkt.clear()
+        blinkt.show()
 
-    elif qrcode == 'cmd:queue':
-        current_playmode = Mode.BUILD_QUEUE
-        phrase = None
-        room = current_device
+    def _run(self):
+        while True:
+            self._changed.wait()
+            self._changed.clear()
 
-        with open(".last-playmode", "w") as playmode_file:
-            playmode_file.write(current_playmode)
+            with self._lock:
+                effect = self._effect
+                until = self._until
 
-    elif qrcode == 'cmd:unqueue':
-        current_playmode = Mode.PLAY_AND_CLEAR
-        phrase = None
-        room = current_device
-        perform_room_request('clearqueue', room)
+            frame_table = LED_EFFECTS.get(effect)
+            if frame_table:
+                blinkt_led_frames.play_frames(frame_table(), until - monotonic(), self._changed)
 
-        with open(".last-playmode", "w") as playmode_file:
-            playmode_file.write(current_playmode)
+            if not self._changed.is_set():
+                self._clear()
+                self._idle.set()
 
-    elif qrcode == 'cmd:playqueue':
-        current_playmode = Mode.PLAY_AND_QUEUE
-        phrase = None
-        room = current_device
+# Flash led lights (onboard or Blinkt! leds), returns the time the feedback started
+def blink_led(type):
+    if use_blinkt == True:
+        # Causes the Blinkt! led bar to blink (without blocking the scanner)
+        log.debug('BLINK LED', effect=type)
+        led_animator.play(type)
+    return monotonic()
+
+# A scanned code, parsed once: `prefix` selects the handler, `value` is the code without
+# the prefix, `params` are the '|' separated and `fields` the ':' separated parts of the code
+Command = collections.namedtuple('Command', ['qrcode', 'prefix', 'value', 'params', 'fields'])
+
+# Parse a code (cards are scanned again and again, so the parsed codes are cached)
+@functools.lru_cache(maxsize=256)
+def parse_qrcode(qrcode):
+    prefix, _, value = qrcode.partition(':')
+    return Command(qrcode, prefix, value, tuple(qrcode.split('|')), tuple(qrcode.split(':')))
+
+
+# Change the play mode and remember it
+def set_playmode(station, playmode):
+    station.state.playmode = playmode
+
+def command_next(command, station):
+    RequestPlan().independent(room_path('next', station.state.device), room_path('play', station.state.device)).run()
+
+def command_unqueue(command, station):
+    set_playmode(station, Mode.PLAY_AND_CLEAR)
+    perform_room_request('clearqueue', station.state.device)
+
+# Commands with a special handling (keyed by the command name, e.g. `cmd:room|<room>` => `room`),
+# all other `cmd:<action>:<value>` codes are passed to the room as `<action>/<value>`. The
+# handlers get the command and the station whose scanner read it.
+COMMAND_HANDLERS = {
+    'playpause': lambda command, station: perform_room_request('playpause', station.state.device),
+    'next': command_next,
+    'previous': lambda command, station: perform_room_request('previous', station.state.device),
+    'queue': lambda command, station: set_playmode(station, Mode.BUILD_QUEUE),
+    'unqueue': command_unqueue,
+    'playqueue': lambda command, station: set_playmode(station, Mode.PLAY_AND_QUEUE),
+    'room': lambda command, station: switch_to_room(station, command.params[1]),
+    'say': lambda command, station: speak(command.params[2], command.params[1])
+}
 
-        with open(".last-playmode", "w") as playmode_file:
-            playmode_file.write(current_playmode)
+# Handling QR command
+# If QR code is defined the Blinkt! led bar is flashing green otherwise red
+def handle_command(command, station):
+    global last_qrcode_success
 
-    elif qrcode.startswith('cmd:room'):
-        room = re.split('\\|', qrcode)[1]
-        switch_to_room(room)
-        phrase = None
+    last_qrcode_success = True
 
-    elif qrcode.startswith('cmd:say'):
-        split = re.split('\\|', qrcode)
-        room = split[1]
-        phrase = split[2]
+    log.debug('HANDLING COMMAND', qrcode=command.qrcode)
 
-    elif len(qrcode.split(':')) == 3:
-        split = re.split('\\:', qrcode)
-        perform_room_request(split[1] + '/' + split[2], room)
-        phrase = None
+    handler = COMMAND_HANDLERS.get(command.params[0][len('cmd:'):])
+    if handler:
+        handler(command, station)
+    elif len(command.fields) == 3:
+        perform_room_request(command.fields[1] + '/' + command.fields[2], station.state.device)
     else:
         last_qrcode_success = False
 
-    if phrase:
-        speak(phrase, room)
 
+# Base class for the handlers of playable items (songs, albums, playlists, ...)
+class ItemHandler:
+    def __init__(self, label):
+        self.label = label
 
-def handle_library_item(qrcode):
-    if not qrcode.startswith('lib:'):
-        return
+    def __call__(self, command, station):
+        if station.state.playmode == Mode.PLAY_AND_CLEAR:
+            perform_room_request('clearqueue', station.state.device)
 
-    print('PLAYING FROM LIBRARY: ' + qrcode)
+        log.debug('PLAYING', source=self.label, qrcode=command.qrcode)
+        perform_room_request(self.path(command, station.state.playmode), station.state.device)
 
-    search = re.split('\\|', qrcode)[1]
+    def path(self, command, playmode):
+        raise NotImplementedError
 
-    if qrcode.startswith('lib:album'):
-        action = 'album'
-    else:
-        action = 'song'
+# Music services (`<service>:<album|song>:<id>`) that can play an item now or add it to the queue
+class ServiceHandler(ItemHandler):
+    def __init__(self, label, endpoint):
+        super().__init__(label)
+        self.endpoint = endpoint
 
-    perform_room_request('musicsearch/library/{0}/{1}'.format(action, urllib.parse.quote(search)), current_device)
+    def path(self, command, playmode):
+        if playmode == Mode.BUILD_QUEUE:
+            action = 'queue'
+        else:
+            action = 'now'
 
+        return '{0}/{1}/{2}'.format(self.endpoint, action, command.value)
 
-def handle_spotify_item(qrcode):
-    print('PLAYING FROM SPOTIFY: ' + qrcode)
+class LibraryHandler(ItemHandler):
+    def path(self, command, playmode):
+        if command.qrcode.startswith('lib:album'):
+            action = 'album'
+        else:
+            action = 'song'
 
-    if current_playmode == Mode.BUILD_QUEUE:
-        action = 'queue'
-    else:
-        action = 'now'
+        return 'musicsearch/library/{0}/{1}'.format(action, urllib.parse.quote(command.params[1]))
 
-    perform_room_request('spotify/{0}/{1}'.format(action, qrcode.replace('spotify:', '')), current_device)
+class FavoritePlaylistHandler(ItemHandler):
+    def path(self, command, playmode):
+        return '{0}/{1}'.format(command.fields[0], urllib.parse.quote(command.fields[1]))
 
-def handle_applemusic_item(qrcode):
-    print('PLAYING FROM APPLE MUSIC: ' + qrcode)
+class TuneinHandler(ItemHandler):
+    def path(self, command, playmode):
+        return '{0}/{1}/{2}'.format(command.fields[0], command.fields[1], command.fields[2])
 
-    if current_playmode == Mode.BUILD_QUEUE:
-        action = 'queue'
-    else:
-        action = 'now'
 
-    perform_room_request('applemusic/{0}/{1}'.format(action, qrcode.replace('applemusic:', '')), current_device)
+# Handlers keyed by the prefix of the code (the part before the first ':')
+QRCODE_HANDLERS = {}
 
+# The prefix of a code (metrics label), `unknown` for codes without a handler
+def code_prefix(qrcode):
+    prefix = parse_qrcode(qrcode).prefix
+    return prefix if prefix in QRCODE_HANDLERS else 'unknown'
 
-def handle_amazonmusic_item(qrcode):
-    print('PLAYING FROM AMAZON MUSIC: ' + qrcode)
+def register_handler(prefix, handler):
+    QRCODE_HANDLERS[prefix] = handler
 
-    if current_playmode == Mode.BUILD_QUEUE:
-        action = 'queue'
-    else:
-        action = 'now'
+register_handler('cmd', handle_command)
+register_handler('spotify', ServiceHandler('SPOTIFY', 'spotify'))
+register_handler('applemusic', ServiceHandler('APPLE MUSIC', 'applemusic'))
+register_handler('amazonmusic', ServiceHandler('AMAZON MUSIC', 'amazonmusic'))
+register_handler('napster', ServiceHandler('NAPSTER', 'napster'))
+register_handler('aldilife', ServiceHandler('ALDI LIFE (NAPSTER)', 'aldilifemusic'))
+register_handler('favorite', FavoritePlaylistHandler('SONOS FAVORITE/PLAYLIST'))
+register_handler('playlist', FavoritePlaylistHandler('SONOS FAVORITE/PLAYLIST'))
+register_handler('tunein', TuneinHandler('TUNEIN'))
+register_handler('lib', LibraryHandler('LIBRARY'))
 
-    perform_room_request('amazonmusic/{0}/{1}'.format(action, qrcode.replace('amazonmusic:', '')), current_device)
 
-def handle_aldilife_item(qrcode):
-    print('PLAYING FROM ALDI LIFE (NAPSTER): ' + qrcode)
+# Handle a code, returns the time the LED feedback started
+def handle_qrcode(qrcode, station):
+    global last_qrcode_success
 
-    if current_playmode == Mode.BUILD_QUEUE:
-        action = 'queue'
-    else:
-        action = 'now'
+    log.debug('HANDLING QRCODE', qrcode=qrcode)
 
-    perform_room_request('aldilifemusic/{0}/{1}'.format(action, qrcode.replace('aldilife:', '')), current_device)
+    command = parse_qrcode(qrcode)
+    handler = QRCODE_HANDLERS.get(command.prefix)
 
-def handle_napster_item(qrcode):
-    print('PLAYING FROM NAPSTER: ' + qrcode)
+    # A newer card replaces a card waiting for `node-sonos-http-api`
+    if isinstance(handler, ItemHandler):
+        offline_buffer.discard(station)
 
-    if current_playmode == Mode.BUILD_QUEUE:
-        action = 'queue'
+    if handler:
+        request_context.reached = True
+        handler(command, station)
     else:
-        action = 'now'
-
-    perform_room_request('napster/{0}/{1}'.format(action, qrcode.replace('napster:', '')), current_device)
+        last_qrcode_success = False
 
-def handle_favorite_playlist_item(qrcode):
-    print('PLAYING FROM SONOS FAVORITE/PLAYLIST: ' + qrcode)
+    station.state.record(qrcode, last_qrcode_success)
 
-    split = re.split('\\:', qrcode)
+    if last_qrcode_success:
+        return blink_led('pulse-green')
+    else:
+        # Play the card when `node-sonos-http-api` is reachable again (only if its request
+        # wasn't sent, otherwise it might be played twice)
+        if isinstance(handler, ItemHandler) and not request_context.reached:
+            offline_buffer.hold(qrcode, station)
+
+        # Don't ignore the card if it is shown again
+        station.scan_filter.forget(qrcode)
+        return blink_led('pulse-red')
+
+
+# Bounded queue between the scanner thread and the dispatcher thread. If the dispatcher
+# can't keep up (e.g. slow Sonos responses), the oldest waiting code is dropped. With the
+# `coalesce` policy a code that is already waiting in the queue isn't added a second time.
+# Each code is queued with the station whose scanner read it, optionally a future, which
+# gets the result of the code (codes from the control socket), and the time the code was
+# received from the scanner.
+class CommandQueue:
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, size=8, policy=COALESCE):
+        self.size = size
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._items = collections.deque()
+        self._unfinished = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+        self.max_dispatch_time = 0.0
+        self.total_dispatch_time = 0.0
+
+    # With `block` the code waits for a free place instead of dropping the oldest one
+    def put(self, qrcode, station=None, future=None, block=False, received=None):
+        with self._cond:
+            if self.policy == CommandQueue.COALESCE and any(item[0] == qrcode and item[2] is station for item in self._items):
+                self.coalesced += 1
+                if future:
+                    future.set_result({'qrcode': qrcode, 'coalesced': True})
+                return
+
+            while block and len(self._items) >= self.size:
+                self._cond.wait()
+
+            if len(self._items) >= self.size:
+                dropped = self._items.popleft()
+                self._unfinished -= 1
+                self.dropped += 1
+                log.warning('DROPPING QRCODE', qrcode=dropped[0])
+                if dropped[3]:
+                    dropped[3].set_result({'qrcode': dropped[0], 'dropped': True})
+
+            queued = monotonic()
+            self._items.append((qrcode, queued, station, future, received or queued))
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    # Wait for the next code, returns the code, the time it waited in the queue, its
+    # station, its future and the time it was received
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+
+            qrcode, queued, station, future, received = self._items.popleft()
+            wait = monotonic() - queued
+            self.max_wait = max(self.max_wait, wait)
+            self.total_wait += wait
+            self._cond.notify_all()
+
+        return qrcode, wait, station, future, received
+
+    def task_done(self, dispatch_time):
+        with self._cond:
+            self._unfinished -= 1
+            self.dispatched += 1
+            self.max_dispatch_time = max(self.max_dispatch_time, dispatch_time)
+            self.total_dispatch_time += dispatch_time
+            self._cond.notify_all()
+
+    # Block until all queued codes are handled
+    def join(self):
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def depth(self):
+        with self._cond:
+            return len(self._items)
+
+    def stats(self):
+        with self._cond:
+            dispatched = max(self.dispatched, 1)
+            return {
+                'depth': len(self._items),
+                'dispatched': self.dispatched,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'avg_wait': self.total_wait / dispatched,
+                'max_wait': self.max_wait,
+                'avg_dispatch_time': self.total_dispatch_time / dispatched,
+                'max_dispatch_time': self.max_dispatch_time
+            }
+
+
+# Filters the scanned codes before they are queued. zbarcam reports a card several times
+# per second as long as it is held in front of the camera:
+# - A code is ignored while it is detected again within the window of its code class
+#   (items or commands), so a card is handled once per scan. Every detection extends the
+#   window, a card lying in front of the camera isn't handled again and again.
+# - Relative commands like `cmd:volume:+5` are added up for the coalesce window (starting
+#   at the first detection) and sent as one command, e.g. five detections of
+#   `cmd:volume:+5` become one `cmd:volume:+25`.
+class ScanFilter:
+    ITEM = 'item'
+    COMMAND = 'command'
+    RELATIVE = 'relative'
+
+    def __init__(self, emit, item_window=30.0, command_window=1.0, coalesce_window=0.5):
+        self.emit = emit
+        self.windows = {ScanFilter.ITEM: item_window, ScanFilter.COMMAND: command_window}
+        self.coalesce_window = coalesce_window
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._pending = {}
+        self.ignored = 0
+        self.coalesced = 0
+
+    def code_class(self, command):
+        if command.prefix != 'cmd':
+            return ScanFilter.ITEM
+
+        if len(command.fields) == 3:
+            value = command.fields[2]
+            if value[:1] in ('+', '-') and value[1:].isdigit():
+                return ScanFilter.RELATIVE
+
+        return ScanFilter.COMMAND
+
+    # Filter a code received from the scanner at `received` (now if not given)
+    def submit(self, qrcode, received=None):
+        now = monotonic()
+        received = received or now
+        command = parse_qrcode(qrcode)
+        code_class = self.code_class(command)
+        metrics.inc('dinoqode_codes_scanned_total', prefix=code_prefix(qrcode))
+
+        with self._lock:
+            if code_class == ScanFilter.RELATIVE:
+                action = command.fields[1]
+                if action in self._pending:
+                    self._pending[action][0] += int(command.fields[2])
+                    self.coalesced += 1
+                    metrics.inc('dinoqode_codes_filtered_total', prefix=command.prefix, reason='coalesced')
+                    return
+
+                timer = threading.Timer(self.coalesce_window, self._flush, [action])
+                self._pending[action] = [int(command.fields[2]), received, now, timer]
+                timer.start()
+                return
+            else:
+                last_seen = self._last_seen.get(code_class)
+                self._last_seen[code_class] = (qrcode, now)
+
+                if last_seen and last_seen[0] == qrcode and now - last_seen[1] < self.windows[code_class]:
+                    self.ignored += 1
+                    metrics.inc('dinoqode_codes_filtered_total', prefix=code_prefix(qrcode), reason='redundant')
+                    log.debug('IGNORING REDUNDANT QRCODE', qrcode=qrcode)
+                    return
+
+        self._emit(qrcode, received, now)
+
+    def _flush(self, action):
+        with self._lock:
+            total, received, submitted, _ = self._pending.pop(action)
+
+        if total:
+            self._emit('cmd:{0}:{1:+d}'.format(action, total), received, submitted)
+
+    # Pass a code on (`submitted`: the time it reached the filter)
+    def _emit(self, qrcode, received, submitted):
+        metrics.observe('dinoqode_stage_seconds', monotonic() - submitted, stage='filter', prefix=code_prefix(qrcode))
+        self.emit(qrcode, received)
+
+    # Block until the pending relative commands are passed on
+    def join(self):
+        with self._lock:
+            timers = [pending[3] for pending in self._pending.values()]
+        for timer in timers:
+            timer.join()
+
+    # Forget a code, so it is handled the next time it is scanned
+    def forget(self, qrcode):
+        with self._lock:
+            for code_class, last_seen in list(self._last_seen.items()):
+                if last_seen[0] == qrcode:
+                    del self._last_seen[code_class]
+
+    def forget_class(self, code_class):
+        with self._lock:
+            self._last_seen.pop(code_class, None)
+
+
+# Parse a line of the QR code scanner output (`QR-Code:<code>`), other lines are ignored.
+# zbar decodes the utf-8 bytes of the codes as Shift JIS, this is reverted if possible.
+def parse_scanner_line(data):
+    if not data.startswith(SCANNER_PREFIX):
+        return None
+
+    qrcode = data[len(SCANNER_PREFIX):].decode('utf-8', 'replace')
+    try:
+        qrcode = qrcode.encode('sjis').decode('utf-8')
+    except UnicodeError:
+        pass
 
-    perform_room_request('{0}/{1}'.format(split[0], urllib.parse.quote(split[1])), current_device)
+    return qrcode.rstrip() or None
 
+SCANNER_PREFIX = b'QR-Code:'
 
-def handle_tunein_item(qrcode):
-    print('PLAYING FROM TUNEIN: ' + qrcode)
 
-    split = re.split('\\:', qrcode)
+# Runs the QR code scanner (zbarcam) and restarts it with an increasing delay if it exits
+# (e.g. if the camera was disconnected). The output of the scanner is read on the calling
+# thread, which never waits for the network, so the scanner output is always consumed.
+#
+# zbarcam can't change its frame rate, so if no code was detected for `idle_after` seconds
+# it is suspended (SIGSTOP) most of the time and only runs for short periods, `idle_fps`
+# times per second, until the next code is detected.
+#
+# zbarcam prints nothing until it detects a code, so it is ready (`on_ready`) when it has
+# opened the camera (a `/dev/video*` file descriptor) or printed its first line.
+class ScannerSupervisor:
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+    # A scanner that ran longer than this was working, restart it without delay (if it
+    # fails again, the delay starts at `MIN_BACKOFF`)
+    STABLE_TIME = 10.0
+    # How long zbarcam runs per idle period (it needs a few frames to detect a code)
+    IDLE_AWAKE_TIME = 0.15
+    # How often to check if zbarcam has opened the camera
+    READY_POLL_INTERVAL = 0.05
+
+    def __init__(self, command, on_qrcode, idle_after=None, idle_fps=None, on_ready=None):
+        self.command = command
+        self.on_qrcode = on_qrcode
+        self.on_ready = on_ready
+        self.idle_after = idle_after
+        self.idle_fps = idle_fps
+        self.idle = False
+        self.process = None
+        self.restarts = 0
+        self.downtime = 0.0
+        self._last_activity = monotonic()
+        self._stopped = threading.Event()
+        self._ready_lock = threading.Lock()
+
+    def run(self):
+        backoff = ScannerSupervisor.MIN_BACKOFF
+        down_since = None
+
+        if self.idle_after and self.idle_fps:
+            threading.Thread(target=self._throttle, name='scanner-idle', daemon=True).start()
+
+        while not self._stopped.is_set():
+            try:
+                self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE)
+            except OSError as e:
+                log.error('SCANNER FAILED TO START', error=e)
+            else:
+                started = monotonic()
+                if down_since is not None:
+                    self.restarts += 1
+                    self.downtime += started - down_since
+                    log.warning('SCANNER RESTARTED', restarts=self.restarts, downtime_s=self.downtime)
+                    down_since = None
+
+                ready = threading.Event()
+                threading.Thread(target=self._wait_until_ready, args=[self.process, ready], name='scanner-ready', daemon=True).start()
+
+                for line in iter(self.process.stdout.readline, b''):
+                    received = monotonic()
+                    self._set_ready(ready)
+                    qrcode = parse_scanner_line(line)
+                    if qrcode:
+                        metrics.observe('dinoqode_stage_seconds', monotonic() - received, stage='parse', prefix=code_prefix(qrcode))
+                        self._last_activity = monotonic()
+                        self.on_qrcode(qrcode, received)
+
+                # End of output: the scanner exited or closed its output
+                self.process.kill()
+                returncode = self.process.wait()
+                if self._stopped.is_set():
+                    break
+
+                log.warning('SCANNER EXITED', exit_code=returncode)
+                if monotonic() - started > ScannerSupervisor.STABLE_TIME:
+                    backoff = 0
+
+            if down_since is None:
+                down_since = monotonic()
+
+            if backoff:
+                self._stopped.wait(backoff)
+            backoff = min(max(backoff * 2, ScannerSupervisor.MIN_BACKOFF), ScannerSupervisor.MAX_BACKOFF)
+
+    def _set_ready(self, ready):
+        with self._ready_lock:
+            if ready.is_set():
+                return
+            ready.set()
+
+        if self.on_ready:
+            self.on_ready()
+
+    # Wait until the process has opened the camera
+    def _wait_until_ready(self, process, ready):
+        fd_directory = '/proc/{0}/fd'.format(process.pid)
+        while not ready.is_set() and process.poll() is None:
+            try:
+                if any(os.readlink(os.path.join(fd_directory, fd)).startswith('/dev/video') for fd in os.listdir(fd_directory)):
+                    self._set_ready(ready)
+                    return
+            except OSError:
+                # File descriptors are opened and closed meanwhile (or there is no `/proc`)
+                pass
+            ready.wait(ScannerSupervisor.READY_POLL_INTERVAL)
+
+    # Suspend and resume the scanner while it is idle
+    def _throttle(self):
+        period = 1.0 / self.idle_fps
+        asleep_time = max(period - ScannerSupervisor.IDLE_AWAKE_TIME, 0)
+
+        while not self._stopped.is_set():
+            idle = monotonic() - self._last_activity > self.idle_after
+            if idle != self.idle:
+                self.idle = idle
+                log.info('SCANNER IDLE' if idle else 'SCANNER ACTIVE')
+
+            process = self.process
+            if not idle or process is None or process.poll() is not None:
+                self._stopped.wait(ScannerSupervisor.IDLE_AWAKE_TIME)
+                continue
+
+            try:
+                process.send_signal(signal.SIGSTOP)
+                self._stopped.wait(asleep_time)
+            finally:
+                process.send_signal(signal.SIGCONT)
+            self._stopped.wait(ScannerSupervisor.IDLE_AWAKE_TIME)
+
+    def stop(self):
+        self._stopped.set()
+        if self.process:
+            self.process.kill()
+
+    def stats(self):
+        return {'restarts': self.restarts, 'downtime': self.downtime}
+
+
+# Handle the queued codes one after the other
+def dispatch_commands():
+    while True:
+        qrcode, wait, station, future, received = command_queue.get()
+
+        # Tells the warm-up that a card is handled (so it doesn't pause the music). If the
+        # warm-up is just sending its startup requests, the card waits until they are done.
+        first = not first_qrcode.is_set()
+        first_qrcode.set()
+        with station.startup_lock:
+            station.card_shown.set()
+
+        start = monotonic()
+        success = False
+        feedback_started = None
+        try:
+            feedback_started = handle_qrcode(qrcode, station)
+            success = last_qrcode_success
+        except Exception:
+            log.error('HANDLING QRCODE FAILED', exc_info=True, qrcode=qrcode)
+        dispatch_time = monotonic() - start
 
-    perform_room_request('{0}/{1}/{2}'.format(split[0], split[1], split[2]), current_device)
+        prefix = code_prefix(qrcode)
+        metrics.observe('dinoqode_stage_seconds', wait, stage='queue', prefix=prefix)
+        metrics.observe('dinoqode_stage_seconds', dispatch_time, stage='dispatch', prefix=prefix)
+        if feedback_started is not None:
+            metrics.observe('dinoqode_stage_seconds', feedback_started - received, stage='feedback', prefix=prefix)
+        metrics.inc('dinoqode_codes_handled_total', prefix=prefix, result='success' if success else 'failure')
 
+        if benchmark:
+            benchmark.record(qrcode, monotonic() - received, success)
+        if future:
+            future.set_result({'qrcode': qrcode, 'station': station.name, 'success': success,
+                               'wait_ms': round(wait * 1000, 1), 'dispatch_ms': round(dispatch_time * 1000, 1)})
+        command_queue.task_done(dispatch_time)
 
-def handle_qrcode(qrcode):
-    global last_qrcode
-    global last_qrcode_success
+        if first:
+            log.info('FIRST QRCODE HANDLED', after_s=monotonic() - started_at)
 
-    # Ignore redundant codes, except for commands like "playpause", where you might
-    # want to perform it multiple times
-    if qrcode == last_qrcode and not qrcode.startswith('cmd:'):
-        print('IGNORING REDUNDANT QRCODE: ' + qrcode)
-        return
-
-    print('HANDLING QRCODE: ' + qrcode)
-
-    if qrcode.startswith('cmd:'):
-        handle_command(qrcode)
-    elif qrcode.startswith('applemusic:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_applemusic_item(qrcode)
-    elif qrcode.startswith('amazonmusic:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_amazonmusic_item(qrcode)
-    elif qrcode.startswith('spotify:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_spotify_item(qrcode)
-    elif qrcode.startswith('napster:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_napster_item(qrcode)
-    elif qrcode.startswith('aldilife:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_aldilife_item(qrcode)
-    elif qrcode.startswith('favorite:') or qrcode.startswith('playlist:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_favorite_playlist_item(qrcode)
-    elif qrcode.startswith('tunein:'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_tunein_item(qrcode)
-    elif qrcode.startswith('lib'):
-        if current_playmode == Mode.PLAY_AND_CLEAR:
-            perform_room_request('clearqueue', current_device)
-
-        handle_library_item(qrcode)
-    else:
-        last_qrcode_success = False
+        log.info('DISPATCHED QRCODE', qrcode=qrcode, station=station.name, success=success,
+                 wait_ms=wait * 1000, dispatch_ms=dispatch_time * 1000, queue_depth=command_queue.depth())
 
-    if last_qrcode_success:
-        last_qrcode = qrcode
-        blink_led('pulse-green')
-    else:
-        last_qrcode = ''
-        blink_led('pulse-red')
 
+def start_dispatcher():
+    threading.Thread(target=dispatch_commands, name='dispatcher', daemon=True).start()
 
-# Monitor the output of the QR code scanner.
+# Start the scanner (one per station) and dispatcher threads
 def start_scan():
-    while True:
-        data = p.stdout.readline()
-
-        if data:
-            data = data.decode('utf-8').encode('sjis').decode('utf-8')
-
-        qrcode = str(data)[8:]
-        if qrcode:
-            qrcode = qrcode.rstrip()
-            handle_qrcode(qrcode)
+    start_dispatcher()
+
+    scanner_threads = []
+    for scanning_station in stations:
+        if scanning_station.scanner is None:
+            continue
+
+        scanner_thread = threading.Thread(target=scanning_station.scanner.run, name='scanner-' + scanning_station.name, daemon=True)
+        scanner_thread.start()
+        scanner_threads.append(scanner_thread)
+
+    # Without scanners the codes only come from the control socket
+    while not scanner_threads:
+        sleep(1)
+
+    # Join with a timeout, so a KeyboardInterrupt still reaches the main thread
+    while any(scanner_thread.is_alive() for scanner_thread in scanner_threads):
+        for scanner_thread in scanner_threads:
+            scanner_thread.join(1)
+
+    # The scanner only stops at the end of a recording, handle the remaining codes
+    command_queue.join()
+
+
+# Control socket: accepts codes like a scanner and returns their results and the state.
+# Every line is a request, every request gets a line with a JSON response:
+# - a code (e.g. `spotify:album:...`) or `{"code": "..."}`: handle the code, returns its result
+# - `{"command": "scan", "codes": [...], "station": "kids", "wait": true, "filter": false}`:
+#   handle several codes (of the first station if none is given). The codes are queued
+#   like the codes of the camera; if the queue is full, the request waits for a free place.
+#   With `"wait": false` the response is sent when all codes are queued. With
+#   `"filter": true` the codes pass the scan filter of the station (repeated cards are
+#   ignored), there are no results then.
+# - `{"command": "state"}`: the state of the stations, the queue and the Sonos API
+# - `{"command": "profile"}`, `{"command": "memory"}`: start or stop a profiling session
+#
+# E.g. `echo 'cmd:next' | nc -U /tmp/dinoqode.sock`
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line) if line.startswith('{') else {'command': 'scan', 'code': line}
+                response = self.respond(request)
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': str(e) or type(e).__name__}
+
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def respond(self, request):
+        command = request.get('command', 'scan')
+        if command == 'scan':
+            return self.scan(request)
+        if command == 'state':
+            return control_state()
+        if command == 'profile':
+            return {'result': toggle_profiling(profiler)}
+        if command == 'memory':
+            return {'result': toggle_profiling(memory_tracer)}
+        raise ValueError('unknown command: {0}'.format(command))
+
+    def scan(self, request):
+        codes = [request['code']] if 'code' in request else request['codes']
+        if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+            raise ValueError('codes must be a list of strings')
+
+        name = request.get('station')
+        target = next((candidate for candidate in stations if name in (None, candidate.name)), None)
+        if target is None:
+            raise ValueError('unknown station: {0}'.format(name))
+
+        if request.get('filter', False):
+            for code in codes:
+                target.scan_filter.submit(code)
+            return {'submitted': len(codes)}
+
+        wait = request.get('wait', True)
+        futures = []
+        for code in codes:
+            future = concurrent.futures.Future() if wait else None
+            command_queue.put(code, target, future, block=True)
+            futures.append(future)
+
+        if not wait:
+            return {'queued': len(codes)}
+
+        results = [future.result() for future in futures]
+        return results[0] if 'code' in request else {'results': results}
+
+
+def control_state():
+    return {
+        'stations': [{'name': control_station.name, 'room': control_station.state.device,
+                      'playmode': control_station.state.playmode, 'last_qrcode': control_station.state.last_qrcode}
+                     for control_station in stations],
+        'queue': command_queue.stats(),
+        'sonos': {'reachable': sonos_breaker.reachable, 'circuit': sonos_breaker.state}
+    }
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Collects the latency (from receiving a code until it is handled) of the codes of the
+# debug file and reports it per code type (e.g. `spotify:album` or `cmd:next`)
+class Benchmark:
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(list)
+        self._failures = collections.Counter()
+        self.submitted = 0
+        self.started = None
+
+    def submitted_code(self):
+        if self.started is None:
+            self.started = monotonic()
+        self.submitted += 1
+
+    # The prefix and the command or the kind of item (without names and ids), e.g.
+    # `cmd:room` for `cmd:room|Küche`, `lib:album` for `lib:album|<name>`, `favorite`
+    @staticmethod
+    def code_type(qrcode):
+        prefix = code_prefix(qrcode)
+        fields = parse_qrcode(qrcode).params[0].split(':')
+        if prefix in ('unknown', 'favorite', 'playlist') or len(fields) < 2:
+            return prefix
+        return '{0}:{1}'.format(prefix, fields[1])
+
+    def record(self, qrcode, latency, success):
+        code_type = Benchmark.code_type(qrcode)
+        with self._lock:
+            self._latencies[code_type].append(latency)
+            if not success:
+                self._failures[code_type] += 1
+
+    # The value below which `percent` percent of the (sorted) values are (nearest rank)
+    @staticmethod
+    def percentile(values, percent):
+        return values[max(int(round(percent / 100.0 * len(values))) - 1, 0)]
+
+    # `coalesced`: relative commands added to another one by the scan filter (they count as
+    # handled)
+    def report(self, coalesced=0):
+        elapsed = monotonic() - (self.started or monotonic())
+        with self._lock:
+            latencies = {code_type: sorted(values) for code_type, values in self._latencies.items()}
+            failures = dict(self._failures)
+
+        handled = sum(len(values) for values in latencies.values()) + coalesced
+        print('BENCHMARK: {0} codes submitted, {1} handled ({2} failed, {3} coalesced, {4} filtered or dropped) in {5:.2f} s, {6:.1f} codes/s'.format(
+            self.submitted, handled, sum(failures.values()), coalesced, self.submitted - handled, elapsed, handled / max(elapsed, 1e-9)))
+        print('{0:<24} {1:>6} {2:>6} {3:>9} {4:>9} {5:>9}'.format('CODE TYPE', 'COUNT', 'FAILED', 'P50 MS', 'P95 MS', 'P99 MS'))
+        for code_type, values in sorted(latencies.items()):
+            print('{0:<24} {1:>6} {2:>6} {3:>9.1f} {4:>9.1f} {5:>9.1f}'.format(
+                code_type, len(values), failures.get(code_type, 0),
+                *[Benchmark.percentile(values, percent) * 1000 for percent in Benchmark.PERCENTILES]))
 
 
 # Read from the `debug.txt` file and handle one code at a time.
 def read_debug_script():
+    start_dispatcher()
+    scanner_ready()
+
     # Read codes from `debug.txt`
     with open(args.debug_file) as f:
         debug_codes = f.readlines()
@@ -381,8 +1767,17 @@ def read_debug_script():
         code = code.split("#")[0]
         code = code.strip()
         if code:
-            handle_qrcode(code)
-            sleep(10)
+            if benchmark:
+                benchmark.submitted_code()
+            stations[0].scan_filter.submit(code)
+            if args.debug_interval > 0:
+                sleep(args.debug_interval)
+
+    stations[0].scan_filter.join()
+    command_queue.join()
+
+    if benchmark:
+        benchmark.report(stations[0].scan_filter.coalesced)
 
 
 # #############################################################################
@@ -393,75 +1788,243 @@ class Mode:
     BUILD_QUEUE = 'build_queue'
     PLAY_AND_QUEUE = 'play_and_queue'
 
-# Load the most recently used device, if available, otherwise fall back on the `default-device` argument
-try:
-    with open('.last-device', 'r') as device_file:
-        current_device = device_file.read().replace('\n', '')
-        print('Defaulting to last used room: ' + current_device)
-except:
-    current_device = args.default_device
-    print('Initial room: ' + current_device)
-
-# Load the last save play mode, if available, otherwise fall back on the `PLAY_AND_QUEUE` argument
+    ALL = [PLAY_AND_CLEAR, BUILD_QUEUE, PLAY_AND_QUEUE]
+
+# A scanner with its own room, play mode and state file. All stations share the
+# connection pool, the command queue and the dispatcher.
+class Station:
+    def __init__(self, name, state, volume, scanner_options):
+        self.name = name
+        self.state = state
+        self.volume = volume
+        self.scanner_options = scanner_options
+        self.scan_filter = ScanFilter(lambda qrcode, received: command_queue.put(qrcode, self, received=received),
+                                      args.item_window, args.command_window, args.coalesce_window)
+        self.card_shown = threading.Event()
+        self.startup_lock = threading.Lock()
+        self.scanner = None
+
+    # Create the QR code reader
+    def create_scanner(self):
+        option = lambda key, default: self.scanner_options.get(key, default)
+
+        backend = option('backend', args.scanner_backend)
+        if backend == 'none':
+            self.scanner = None
+        elif backend == 'inprocess':
+            import qrscan
+            self.scanner = qrscan.FrameScanner(option('source', args.scanner_source), self.scan_filter.submit,
+                                               qrscan.FrameDecoder(max_size=option('max_size', args.scanner_max_size)),
+                                               option('fps', args.scanner_fps), args.idle_after, args.idle_fps, scanner_ready)
+        else:
+            self.scanner = ScannerSupervisor(shlex.split(option('command', args.scanner_command)), self.scan_filter.submit,
+                                             args.idle_after, args.idle_fps, scanner_ready)
+
+# Create the stations from the `--config` file, e.g.
+# {"stations": [{"name": "kids", "room": "Kinderzimmer", "command": "/usr/bin/zbarcam --nodisplay /dev/video0"}, ...]}
+# Without a config file there is one station for the command line arguments.
+def load_stations():
+    if not args.config:
+        return [(args.default_device, StateStore(args.state_file, args.default_device, Mode.PLAY_AND_QUEUE, legacy=True), args.default_volume, {})]
+
+    try:
+        with open(args.config) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        arg_parser.error('cannot read config file: {0}'.format(e))
+
+    result = []
+    for options in config.get('stations', []):
+        room = options.get('room', args.default_device)
+        name = options.get('name', room)
+        playmode = options.get('playmode', Mode.PLAY_AND_QUEUE)
+        if playmode not in Mode.ALL:
+            arg_parser.error('unknown play mode of station {0}: {1}'.format(name, playmode))
+
+        state_file = options.get('state_file', '.dinoqode-state-{0}.json'.format(name))
+        result.append((name, StateStore(state_file, room, playmode), str(options.get('volume', args.default_volume)), options))
+
+    if not result:
+        arg_parser.error('no stations in config file: ' + args.config)
+    return result
+
+metrics = Metrics()
+metrics.describe('dinoqode_codes_scanned_total', 'counter', 'Codes read by the scanners.')
+metrics.describe('dinoqode_codes_filtered_total', 'counter', 'Codes ignored as repeated reads or added to a coalesced relative command.')
+metrics.describe('dinoqode_codes_handled_total', 'counter', 'Codes handled by the dispatcher.')
+metrics.describe('dinoqode_stage_seconds', 'histogram', 'Seconds per stage of the scan path (parse: scanner output parsed, filter: scan filter incl. coalescing, queue: waiting for the dispatcher, dispatch: handling the code, feedback: code received until the LED feedback started).')
+metrics.describe('dinoqode_request_seconds', 'histogram', 'Seconds per request to node-sonos-http-api.')
+metrics.describe('dinoqode_request_errors_total', 'counter', 'Failed requests to node-sonos-http-api.')
+metrics.describe('dinoqode_requests_skipped_total', 'counter', 'Requests skipped because they would not change the state of the room.')
+metrics.describe('dinoqode_queue_depth', 'gauge', 'Codes waiting for the dispatcher.', lambda: command_queue.depth())
+metrics.describe('dinoqode_queue_dropped_total', 'counter', 'Codes dropped because the queue was full.', lambda: command_queue.dropped)
+metrics.describe('dinoqode_sonos_available', 'gauge', '1 if node-sonos-http-api is reachable.', lambda: int(sonos_breaker.reachable))
+metrics.describe('dinoqode_scanner_restarts_total', 'counter', 'Restarts of the scanner processes.',
+                 lambda: sum(getattr(station.scanner, 'restarts', 0) for station in stations))
+
+# Result of the last request
+last_qrcode_success = True
+
+if args.stub:
+    args.hostname = '127.0.0.1'
+
+base_url = 'http://' + args.hostname + ':' + str(args.port)
+command_queue = CommandQueue(args.queue_size, args.queue_policy)
+
+# Load the most recently used device and play mode of every station, if available,
+# otherwise fall back on the `default-device` argument (or the room of the station in the
+# config file) and the `PLAY_AND_QUEUE` play mode
 # PLAY_AND_QUEUE = Play current album/song and don't clear the queue
 # PLAY_AND_CLEAR = Play current album/song and clear the queue
 # BUILD_QUEUE = Add current album/song to the queue
+stations = []
+for name, station_state, volume, scanner_options in load_stations():
+    stations.append(Station(name, station_state, volume, scanner_options))
+    loaded = station_state.load()
+    log.info('STATION', name=stations[-1].name, room=station_state.device, room_restored='device' in loaded,
+             playmode=station_state.playmode, playmode_restored='playmode' in loaded)
+    atexit.register(station_state.flush)
+
+benchmark = Benchmark() if args.benchmark else None
+
+if args.stub:
+    import sonos_stub
+    sonos_stub.SonosStub(args.port, [station.state.device for station in stations],
+                         args.stub_latency, args.stub_jitter, args.stub_error_rate).start()
+    log.info('USING SONOS STUB', port=args.port)
+zone_cache = ZoneCache(args.zone_max_age)
+sonos_pool = ConnectionPool(args.hostname, args.port, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+offline_buffer = OfflineBuffer(args.replay_window)
+sonos_breaker = CircuitBreaker(args.breaker_threshold, args.breaker_reset, offline_buffer.replay)
+threading.Thread(target=sonos_breaker.probe_periodically, args=['/zones'], name='sonos-probe', daemon=True).start()
+
+if use_blinkt == True:
+    led_animator = LedAnimator()
+
+# Called by the scanner as soon as it is running
+def scanner_ready():
+    if not scanner_started.is_set():
+        scanner_started.set()
+        log.info('READY TO SCAN', after_s=monotonic() - started_at)
+        blink_led('rainbow')
 
-try:
-    with open('.last-playmode', 'r') as playmode_file:
-        current_playmode = playmode_file.read().replace('\n', '')
-        print('Defaulting to last used play mode: ' + current_playmode)
-except:
-    current_playmode = Mode.PLAY_AND_QUEUE
-    print('Play mode: ' + current_playmode)
-
-# Keep track of the last-seen code
-last_qrcode = ''
-last_qrcode_success = True
+# Startup requests, they run in the background while the scanner is already running
+def warm_up():
+    # Load the state of the rooms, so needless startup requests can be skipped
+    zone_cache.refresh()
+
+    # The library is shared by all rooms, it is only loaded once
+    for station in stations:
+        warm_up_station(station, station is stations[0] and not args.skip_load)
+
+    log.info('WARM-UP COMPLETE', after_s=monotonic() - started_at)
 
-base_url = 'http://' + args.hostname + ':5005'
-current_dir = os.path.dirname(os.path.abspath(__file__))
+def warm_up_station(station, load_library):
+    state = station.state
 
-perform_room_request('pause', current_device)
-perform_room_request('volume/' + args.default_volume, current_device)
+    # Don't pause the music or speak if a card was shown in the meantime. The first card
+    # is handled after the startup requests (`startup_lock`), so they can't undo it.
+    with station.startup_lock:
+        if not station.card_shown.is_set():
+            RequestPlan().independent(
+                room_path('pause', state.device),
+                room_path('volume/' + station.volume, state.device)
+            ).execute()
 
-if args.speak_welcome:
-    speak('Hallo, ich bin dinoqode.')
+    def welcome(phrase):
+        if args.speak_welcome and not station.card_shown.is_set():
+            log.info('SPEAKING', phrase=phrase, room=state.device)
+            request_path(room_path(speak_path(phrase), state.device))
 
-if not args.skip_load:
-    # Preload library on startup (it takes a few seconds to prepare the cache)
-    print('Indexing the library...')
-    if args.speak_welcome:
-        speak('Musik Bibliothek indizieren')
+    welcome('Hallo, ich bin dinoqode.')
 
-    perform_room_request('musicsearch/library/load', current_device)
-    print('Indexing complete!')
+    if load_library:
+        # Preload library on startup (it takes a few seconds to prepare the cache)
+        log.info('INDEXING THE LIBRARY')
+        welcome('Musik Bibliothek indizieren')
 
-    if args.speak_welcome:
-        speak('Jetzt bin ich bereit!')
+        request_path(room_path('musicsearch/library/load', state.device), args.read_timeout)
+        log.info('INDEXING COMPLETE')
 
-if args.speak_welcome:
-    speak('Zeig mir eine Karte!')
+        welcome('Jetzt bin ich bereit!')
 
+    welcome('Zeig mir eine Karte!')
+
+scanner_started = threading.Event()
+first_qrcode = threading.Event()
+threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+if args.zone_refresh > 0:
+    threading.Thread(target=zone_cache.refresh_periodically, args=[args.zone_refresh], name='zones', daemon=True).start()
+
+# Profiling sessions (nothing runs until a session is started)
+profiler = qrprofile.SamplingProfiler(args.profile_dir, args.profile_interval)
+memory_tracer = qrprofile.MemoryTracer(args.profile_dir)
+
+def toggle_profiling(session):
+    try:
+        result = session.toggle()
+    except OSError as e:
+        result = 'Cannot write report: {0}'.format(e)
+    log.info('PROFILING', session=type(session).__name__, result=result)
+    return result
+
+# Start and stop profiling with `kill -USR2 <pid>`
+signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=toggle_profiling, args=[profiler]).start())
+
+if args.control_socket:
+    # Remove the socket of a previous run
+    if os.path.exists(args.control_socket):
+        os.remove(args.control_socket)
+    try:
+        control_server = ThreadingUnixServer(args.control_socket, ControlHandler)
+    except OSError as e:
+        log.error('CANNOT OPEN CONTROL SOCKET', path=args.control_socket, error=e)
+    else:
+        atexit.register(os.remove, args.control_socket)
+        threading.Thread(target=control_server.serve_forever, name='control', daemon=True).start()
+
+if args.control_port:
+    # e.g. the port is already used by another program (`node-sonos-http-api` uses 5005, `server.js` 5006)
+    try:
+        control_tcp_server = ThreadingTCPServer(('127.0.0.1', args.control_port), ControlHandler)
+    except OSError as e:
+        log.error('CANNOT OPEN CONTROL PORT', port=args.control_port, error=e)
+    else:
+        threading.Thread(target=control_tcp_server.serve_forever, name='control-tcp', daemon=True).start()
+
+if args.metrics_port:
+    metrics_server = http.server.ThreadingHTTPServer((args.metrics_address, args.metrics_port), MetricsHandler)
+    threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+
+if args.webhook_port:
+    webhook_server = http.server.ThreadingHTTPServer((args.webhook_address, args.webhook_port), WebhookHandler)
+    threading.Thread(target=webhook_server.serve_forever, name='webhook', daemon=True).start()
 
 if args.debug_file:
     # Run through a list of codes from a local file
     read_debug_script()
 else:
-    # Start the QR code reader
-    p = subprocess.Popen('/usr/bin/zbarcam --prescale=500x500 --nodisplay', shell=True, stdout=subprocess.PIPE)
+    # Start the QR code readers
+    for scanning_station in stations:
+        scanning_station.create_scanner()
 
     try:
-        blink_led('rainbow')
         start_scan()
     except KeyboardInterrupt:
-        print('Stopping scanner...')
+        log.info('STOPPING SCANNER')
         blink_led('pulse-red')
+        if use_blinkt == True:
+            led_animator.wait(LedAnimator.DURATION)
+    except Exception:
+        log.error('SCANNING FAILED', exc_info=True)
+        raise
     finally:
-        print('Closed')
+        log.info('CLOSED')
         if use_blinkt == True:
-            blinkt.clear()
-            blinkt.show()
+            led_animator.stop()
+            led_animator.wait(1)
 
-        traceback.print_exc()
-        p.kill()
+        for scanning_station in stations:
+            if scanning_station.scanner:
+                scanning_station.scanner.stop()
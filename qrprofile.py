@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf8
+
+#
+# Copyright (c) 2019 Stefan Kienzle
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# On-demand profiling of a running `qrplay`. Both sessions are started by one trigger
+# and stopped (and written to a file) by the next one; nothing runs while they are off.
+#
+# - `SamplingProfiler` records the stacks of all threads (dispatcher, scanners, request
+#   workers, ...) a few hundred times per second. `cProfile` would only see the thread
+#   that started it. The result is a summary of the busiest functions per thread and the
+#   stacks in the "folded" format of flame graph tools (e.g. `flamegraph.pl`).
+# - `MemoryTracer` traces the memory allocations with `tracemalloc` and writes the
+#   allocations that grew most between the start and the end of the session.
+
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def report_path(directory, kind, extension):
+    return os.path.join(directory, 'dinoqode-{0}-{1}.{2}'.format(kind, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+
+class SamplingProfiler:
+    def __init__(self, directory='/tmp', interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
+        self._stacks = collections.Counter()
+        self._started = 0.0
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    # Start a session or stop the running one, returns a description of what happened
+    def toggle(self):
+        with self._lock:
+            if self._thread is None:
+                self._start()
+                return 'Profiling started'
+            return 'Profile written to ' + ', '.join(self._stop())
+
+    def _start(self):
+        self._stacks = collections.Counter()
+        self.samples = 0
+        self._started = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def _stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        return self.write()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    # Write the summary and the folded stacks, returns the paths of the files
+    def write(self):
+        duration = time.monotonic() - self._started
+        summary_path = report_path(self.directory, 'profile', 'txt')
+        folded_path = report_path(self.directory, 'profile', 'folded')
+
+        # Samples per thread and per innermost function (where the time is spent)
+        threads = collections.Counter()
+        functions = collections.Counter()
+        for stack, count in self._stacks.items():
+            frames = stack.split(';')
+            threads[frames[0]] += count
+            if len(frames) > 1:
+                functions[(frames[0], frames[-1])] += count
+
+        with open(summary_path, 'w') as summary:
+            summary.write('{0} samples in {1:.1f} s (every {2:.0f} ms)\n\n'.format(self.samples, duration, self.interval * 1000))
+            summary.write('Samples per thread:\n')
+            for thread, count in threads.most_common():
+                summary.write('{0:>8} {1}\n'.format(count, thread))
+
+            summary.write('\nBusiest functions (thread: function):\n')
+            for (thread, function), count in functions.most_common(50):
+                summary.write('{0:>8} {1:>5.1f}%  {2}: {3}\n'.format(count, 100.0 * count / max(self.samples, 1), thread, function))
+
+        with open(folded_path, 'w') as folded:
+            for stack, count in self._stacks.most_common():
+                folded.write('{0} {1}\n'.format(stack, count))
+
+        return [summary_path, folded_path]
+
+
+class MemoryTracer:
+    FRAMES = 10
+    TOP = 30
+
+    def __init__(self, directory='/tmp'):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    @property
+    def running(self):
+        return self._snapshot is not None
+
+    # Start tracing or write the difference since the start and stop tracing, returns a
+    # description of what happened
+    def toggle(self):
+        with self._lock:
+            if self._snapshot is None:
+                tracemalloc.start(MemoryTracer.FRAMES)
+                self._snapshot = tracemalloc.take_snapshot()
+                return 'Memory tracing started'
+
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # Ignore the allocations of tracemalloc itself
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            differences = snapshot.filter_traces(filters).compare_to(self._snapshot.filter_traces(filters), 'traceback')
+            self._snapshot = None
+
+            path = report_path(self.directory, 'memory', 'txt')
+            with open(path, 'w') as report:
+                report.write('Traced memory: {0:.1f} KiB (peak {1:.1f} KiB)\n\n'.format(current / 1024.0, peak / 1024.0))
+                report.write('Top {0} differences since the start:\n'.format(MemoryTracer.TOP))
+                for difference in differences[:MemoryTracer.TOP]:
+                    report.write('\n{0:+.1f} KiB in {1:+d} blocks ({2:.1f} KiB in {3} blocks)\n'.format(
+                        difference.size_diff / 1024.0, difference.count_diff, difference.size / 1024.0, difference.count))
+                    for line in difference.traceback.format():
+                        report.write(line + '\n')
+
+            return 'Memory report written to ' + path
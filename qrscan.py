@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# coding: utf8
+
+#
+# Copyright (c) 2019 Stefan Kienzle
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# In-process QR code scanner (alternative to `zbarcam`).
+#
+# Frames are read from a V4L2 camera, a video file or a directory of recorded frames (so
+# the scanner can be tested and benchmarked without a camera). To keep the CPU usage low:
+# - frames that didn't change since the last decoded frame are not decoded again,
+# - the frame is searched around the last detected code first (region of interest),
+# - the frame is downscaled, the scale adapts to the size of the last detected code (until
+#   no code was detected for a few frames).
+#
+# Requires OpenCV (`sudo apt-get install python3-opencv`). If `pyzbar` is installed, zbar
+# is used for decoding (like `zbarcam`), otherwise the OpenCV QR code detector.
+#
+# Run `python3 qrscan.py --source <device|video|directory>` to print the detected codes
+# and decoding statistics.
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.pgm')
+
+log = logging.getLogger('qrscan')
+
+
+def is_recording(source):
+    return os.path.isdir(source) or os.path.isfile(source)
+
+
+# Yield grayscale frames from a camera device, a video file or a directory of images
+def read_frames(source):
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(os.path.join(source, name), cv2.IMREAD_GRAYSCALE)
+                if frame is not None:
+                    yield frame
+        return
+
+    if source.isdigit():
+        capture = cv2.VideoCapture(int(source))
+    elif source.startswith('/dev/'):
+        capture = cv2.VideoCapture(source, cv2.CAP_V4L2)
+    else:
+        capture = cv2.VideoCapture(source)
+
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    finally:
+        capture.release()
+
+
+# Decodes the QR codes of a frame, returns a list of (code, rect) tuples. The rect
+# (x, y, width, height) is given in the coordinates of the image.
+def decode_image(image, detector=None):
+    if pyzbar is not None:
+        return [(symbol.data.decode('utf-8', 'replace'), tuple(symbol.rect))
+                for symbol in pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.QRCODE])]
+
+    if detector is None:
+        detector = cv2.QRCodeDetector()
+
+    # Only one code per frame (the multi code detector is much less reliable)
+    code, points, _ = detector.detectAndDecode(image)
+    if not code or points is None:
+        return []
+
+    return [(code, cv2.boundingRect(points.reshape(-1, 2).astype('float32')))]
+
+
+class FrameDecoder:
+    # Frames are downscaled so the last detected code is about this wide (in pixels)
+    TARGET_CODE_SIZE = 160
+    # Side length of the thumbnail used to detect frame changes
+    THUMBNAIL_SIZE = 32
+    # The size of the last detected code is forgotten after this many decoded frames without
+    # a code (the next card may be smaller or farther away)
+    CODE_SIZE_FRAMES = 10
+
+    def __init__(self, max_size=500, min_size=240, change_threshold=2.0, roi_margin=0.75):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.change_threshold = change_threshold
+        self.roi_margin = roi_margin
+        self._detector = cv2.QRCodeDetector() if pyzbar is None else None
+        self._thumbnail = None
+        self._codes = []
+        self._roi = None
+        self._code_size = None
+        self._misses = 0
+        self.changed = True
+        self.frames = 0
+        self.skipped = 0
+        self.roi_hits = 0
+        self.decode_time = 0.0
+
+    # Returns the codes of the frame (the codes of the last frame if nothing changed)
+    def decode(self, frame):
+        self.frames += 1
+
+        thumbnail = cv2.resize(frame, (self.THUMBNAIL_SIZE, self.THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+        self.changed = self._thumbnail is None or cv2.absdiff(thumbnail, self._thumbnail).mean() >= self.change_threshold
+        if not self.changed:
+            self.skipped += 1
+            return self._codes
+        self._thumbnail = thumbnail
+
+        start = time.monotonic()
+        found = []
+        if self._roi is not None:
+            found = self._decode_region(frame, self._roi)
+            if found:
+                self.roi_hits += 1
+
+        if not found:
+            height, width = frame.shape[:2]
+            found = self._decode_region(frame, (0, 0, width, height))
+        self.decode_time += time.monotonic() - start
+
+        self._codes = [code for code, _ in found]
+        if found:
+            x0 = min(rect[0] for _, rect in found)
+            y0 = min(rect[1] for _, rect in found)
+            x1 = max(rect[0] + rect[2] for _, rect in found)
+            y1 = max(rect[1] + rect[3] for _, rect in found)
+            self._roi = (x0, y0, x1 - x0, y1 - y0)
+            self._code_size = max(rect[2] for _, rect in found)
+            self._misses = 0
+        else:
+            self._roi = None
+            self._misses += 1
+            if self._misses >= self.CODE_SIZE_FRAMES:
+                self._code_size = None
+
+        return self._codes
+
+    # The scale for a region, so the code is still big enough to be decoded
+    def _scale(self, width, height):
+        longest = max(width, height)
+        target = self.max_size
+
+        if self._code_size:
+            target = longest * self.TARGET_CODE_SIZE / float(self._code_size)
+            target = min(max(target, self.min_size), self.max_size)
+
+        return min(1.0, target / float(longest))
+
+    def _decode_region(self, frame, region):
+        x, y, width, height = region
+        frame_height, frame_width = frame.shape[:2]
+
+        # Add a margin around the region, so a moved card is still inside
+        margin_x = int(width * self.roi_margin)
+        margin_y = int(height * self.roi_margin)
+        x0, y0 = max(x - margin_x, 0), max(y - margin_y, 0)
+        x1, y1 = min(x + width + margin_x, frame_width), min(y + height + margin_y, frame_height)
+
+        image = frame[y0:y1, x0:x1]
+        scale = self._scale(x1 - x0, y1 - y0)
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        return [(code, (int(rx / scale) + x0, int(ry / scale) + y0, int(rw / scale), int(rh / scale)))
+                for code, (rx, ry, rw, rh) in decode_image(image, self._detector)]
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'roi_hits': self.roi_hits,
+            'decode_time': self.decode_time
+        }
+
+
+# Reads frames from a source and passes the detected codes to `on_qrcode` (same interface
+# as the `zbarcam` supervisor in `qrplay`). A camera is opened again if it fails, a
+# recording is scanned once.
+#
+# If nothing changed in front of the camera for `idle_after` seconds, the scanner only
+# reads `idle_fps` frames per second until a frame changes or a code is detected.
+class FrameScanner:
+    REOPEN_DELAY = 2.0
+
+    def __init__(self, source, on_qrcode, decoder=None, max_fps=None, idle_after=None, idle_fps=None, on_ready=None):
+        if cv2 is None:
+            raise RuntimeError('The in-process scanner requires OpenCV\nInstall with: sudo apt-get install python3-opencv')
+
+        self.source = source
+        self.on_qrcode = on_qrcode
+        self.on_ready = on_ready
+        self.decoder = decoder or FrameDecoder()
+        self.max_fps = max_fps
+        self.idle_after = idle_after
+        self.idle_fps = idle_fps
+        self.idle = False
+        self._last_activity = time.monotonic()
+        self._stopped = threading.Event()
+
+    # The frame rate for the next frame (lower in idle mode)
+    def _frame_rate(self, now):
+        idle = bool(self.idle_after and self.idle_fps and now - self._last_activity > self.idle_after)
+        if idle != self.idle:
+            self.idle = idle
+            log.info('SCANNER IDLE' if idle else 'SCANNER ACTIVE')
+
+        return self.idle_fps if idle else self.max_fps
+
+    def run(self):
+        while not self._stopped.is_set():
+            last_frame = time.monotonic()
+
+            for frame in read_frames(self.source):
+                if self._stopped.is_set():
+                    return
+
+                # The camera delivers frames, the scanner is ready
+                if self.on_ready and self.decoder.frames == 0:
+                    self.on_ready()
+
+                codes = self.decoder.decode(frame)
+                for qrcode in codes:
+                    self.on_qrcode(qrcode)
+
+                now = time.monotonic()
+                if codes or self.decoder.changed:
+                    self._last_activity = now
+
+                fps = self._frame_rate(now)
+                if fps:
+                    last_frame += 1.0 / fps
+                    if self._stopped.wait(max(last_frame - time.monotonic(), 0)):
+                        return
+                    last_frame = max(last_frame, time.monotonic() - 1.0 / fps)
+
+            if is_recording(self.source):
+                return
+
+            log.warning('CAMERA FAILED source=%s', self.source)
+            self._stopped.wait(self.REOPEN_DELAY)
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return self.decoder.stats()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Scans QR codes from a camera, a video or a directory of frames.')
+    arg_parser.add_argument('--source', default='/dev/video0', help='camera device, video file or directory of recorded frames')
+    arg_parser.add_argument('--max-size', default=500, type=int, help='maximum size (in pixels) frames are decoded at')
+    arg_parser.add_argument('--fps', default=None, type=float, help='maximum number of frames per second (default: as fast as possible)')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    scanner = FrameScanner(args.source, lambda qrcode: print('QR-Code:' + qrcode),
+                           FrameDecoder(max_size=args.max_size), args.fps)
+
+    start = time.monotonic()
+    try:
+        scanner.run()
+    except KeyboardInterrupt:
+        pass
+
+    stats = scanner.stats()
+    elapsed = time.monotonic() - start
+    print('{0} frames in {1:.2f} s ({2:.1f} fps), {3} skipped, {4} region of interest hits, {5:.2f} s decoding'.format(
+        stats['frames'], elapsed, stats['frames'] / max(elapsed, 1e-9), stats['skipped'], stats['roi_hits'], stats['decode_time']))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf8
+
+#
+# Copyright (c) 2019 Stefan Kienzle
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Stub of the `node-sonos-http-api` endpoints used by `qrplay`, so `qrplay` can be tested
+# and benchmarked without Sonos speakers. Every request is answered after a configurable
+# latency (plus random jitter), a configurable share of the requests fails.
+#
+# The stub keeps a minimal state per room (playback state and volume), which is returned
+# by `/zones` and `/<room>/state`, and records the paths of the requests (`requests`).
+# `stop()` also closes the open keep-alive connections, like a restarted API.
+#
+# Run `python3 sonos_stub.py --port 5005 --latency 0.05 --error-rate 0.1` or start it
+# in-process with `qrplay.py --stub` (see `--benchmark`).
+
+import argparse
+import http.server
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+
+class SonosStubHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive connections like `node-sonos-http-api`
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stub.opened(self.connection)
+
+    def finish(self):
+        super().finish()
+        self.server.stub.closed(self.connection)
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.received(urllib.parse.unquote(self.path))
+        delay = stub.latency + random.uniform(0, stub.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if stub.drop_connections:
+            # Close the connection without a response (e.g. the API crashed)
+            self.close_connection = True
+            return
+
+        if random.random() < stub.error_rate:
+            self.send_json(500, {'status': 'error', 'error': 'injected error'})
+            return
+
+        segments = [urllib.parse.unquote(segment) for segment in self.path.split('/')[1:]]
+        if segments == ['zones']:
+            self.send_json(200, stub.zones())
+        elif len(segments) >= 2 and segments[1] == 'state':
+            self.send_json(200, stub.room_state(segments[0]))
+        elif len(segments) >= 2:
+            stub.apply(segments[0], segments[1:])
+            self.send_json(200, {'status': 'success'})
+        else:
+            self.send_json(404, {'status': 'error', 'error': 'unknown endpoint'})
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting (e.g. a read timeout)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SonosStub:
+    def __init__(self, port=5005, rooms=(), latency=0.0, jitter=0.0, error_rate=0.0, host='127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_connections = False
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._connections = set()
+        self.requests = []
+        for room in rooms:
+            self.room_state(room)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), SonosStubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+
+    def room_state(self, room):
+        with self._lock:
+            room_state = self._rooms.setdefault(room, {'playbackState': 'STOPPED', 'volume': 20, 'mute': False})
+            return dict(room_state)
+
+    def zones(self):
+        with self._lock:
+            rooms = sorted(self._rooms.items())
+        return [{'uuid': room, 'coordinator': {'roomName': room, 'state': dict(room_state)},
+                 'members': [{'roomName': room, 'state': dict(room_state)}]} for room, room_state in rooms]
+
+    # Update the state of a room like the action would
+    def apply(self, room, action):
+        self.room_state(room)
+        with self._lock:
+            room_state = self._rooms[room]
+            if action[0] == 'pause':
+                room_state['playbackState'] = 'PAUSED_PLAYBACK'
+            elif action[0] == 'playpause':
+                room_state['playbackState'] = 'PAUSED_PLAYBACK' if room_state['playbackState'] == 'PLAYING' else 'PLAYING'
+            elif action[0] in ('play', 'next', 'previous') or len(action) >= 2 and action[1] == 'now':
+                room_state['playbackState'] = 'PLAYING'
+            elif action[0] == 'volume' and len(action) == 2:
+                try:
+                    if action[1][0] in '+-':
+                        room_state['volume'] = min(max(room_state['volume'] + int(action[1]), 0), 100)
+                    else:
+                        room_state['volume'] = int(action[1])
+                except ValueError:
+                    pass
+
+    def received(self, path):
+        with self._lock:
+            self.requests.append(path)
+
+    def opened(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def closed(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    # Serve requests in a background thread
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='sonos-stub', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Stub of the node-sonos-http-api endpoints used by qrplay.')
+    arg_parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    arg_parser.add_argument('--port', default=5005, type=int, help='the port to listen on')
+    arg_parser.add_argument('--rooms', default='Büro', help='comma separated names of the rooms returned by `/zones`')
+    arg_parser.add_argument('--latency', default=0.0, type=float, help='seconds every request takes')
+    arg_parser.add_argument('--jitter', default=0.0, type=float, help='maximum random seconds added to the latency')
+    arg_parser.add_argument('--error-rate', default=0.0, type=float, help='share of the requests that fail (0 to 1)')
+    args = arg_parser.parse_args()
+
+    stub = SonosStub(args.port, args.rooms.split(','), args.latency, args.jitter, args.error_rate, args.host)
+    print('Sonos stub listening on {0}:{1}'.format(args.host, args.port))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding: utf8
+
+#
+# Copyright (c) 2019 Stefan Kienzle
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Runs `qrplay` against `sonos_stub` (stopped and started again to simulate a restart of
+# `node-sonos-http-api`) and sends the cards through the control socket.
+#
+# Run `python3 -m unittest discover tests`
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sonos_stub
+
+ROOM = 'Büro'
+ALBUM_A = 'spotify:album:A'
+ALBUM_B = 'spotify:album:B'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class OfflineBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.sonos_port = free_port()
+        self.control_port = free_port()
+        self.stub = sonos_stub.SonosStub(self.sonos_port, [ROOM]).start()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.qrplay = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'qrplay.py'), '--hostname', '127.0.0.1', '--port', str(self.sonos_port),
+             '--default-device', ROOM, '--scanner-backend', 'none', '--control-port', str(self.control_port),
+             '--zone-refresh', '0', '--retries', '0', '--breaker-threshold', '10', '--read-timeout', '0.3',
+             '--state-file', os.path.join(self.directory.name, 'state.json'), '--log-ring-size', '0'],
+            cwd=self.directory.name, stdout=subprocess.DEVNULL)
+
+        # Wait for the control socket and the startup requests
+        self.control = None
+        self.assertTrue(wait_for(self.connect_control), 'control socket not available')
+        self.assertTrue(wait_for(lambda: '/{0}/volume/25'.format(ROOM) in self.stub.requests), 'no startup requests')
+
+    def tearDown(self):
+        self.control.close()
+        self.qrplay.terminate()
+        self.qrplay.wait()
+        self.stub.stop()
+        self.directory.cleanup()
+
+    def connect_control(self):
+        try:
+            self.control = socket.create_connection(('127.0.0.1', self.control_port))
+        except OSError:
+            return False
+        self.control_file = self.control.makefile('rwb')
+        return True
+
+    def scan(self, code):
+        self.control_file.write(code.encode('utf-8') + b'\n')
+        self.control_file.flush()
+        return json.loads(self.control_file.readline().decode('utf-8'))
+
+    # Restart the stub on the same port (without the requests received so far)
+    def restart_stub(self):
+        self.stub = sonos_stub.SonosStub(self.sonos_port, [ROOM]).start()
+
+    def played(self, code):
+        path = '/{0}/spotify/now/{1}'.format(ROOM, code.partition(':')[2])
+        return self.stub.requests.count(path)
+
+    def test_unsent_card_is_replayed_once(self):
+        self.stub.stop()
+        self.assertFalse(self.scan(ALBUM_A)['success'])
+
+        self.restart_stub()
+        self.assertTrue(self.scan('cmd:volume:+1')['success'])
+        self.assertTrue(wait_for(lambda: self.played(ALBUM_A) == 1))
+        time.sleep(0.5)
+        self.assertEqual(self.played(ALBUM_A), 1)
+
+    def test_newer_card_discards_buffered_card(self):
+        self.stub.stop()
+        self.assertFalse(self.scan(ALBUM_A)['success'])
+
+        self.restart_stub()
+        self.assertTrue(self.scan(ALBUM_B)['success'])
+        time.sleep(0.5)
+        self.assertEqual(self.played(ALBUM_A), 0)
+        self.assertEqual(self.played(ALBUM_B), 1)
+
+    def test_card_that_reached_the_api_is_not_replayed(self):
+        # The request reaches the stub, but the response is too late
+        self.stub.latency = 1.0
+        self.assertFalse(self.scan(ALBUM_A)['success'])
+
+        self.stub.latency = 0.0
+        self.assertTrue(self.scan('cmd:volume:+1')['success'])
+        time.sleep(0.5)
+        self.assertEqual(self.played(ALBUM_A), 1)
+
+    def test_card_is_not_sent_again_when_the_connection_drops(self):
+        # The request reaches the stub on a keep-alive connection, which is closed instead of
+        # a response
+        self.stub.drop_connections = True
+        self.assertFalse(self.scan(ALBUM_A)['success'])
+
+        self.stub.drop_connections = False
+        self.assertTrue(self.scan('cmd:volume:+1')['success'])
+        time.sleep(0.5)
+        self.assertEqual(self.played(ALBUM_A), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()